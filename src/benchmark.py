@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+import mcl
+
+from calculate_similarity import Similarity
+from deduplicate import deduplicate, weights, expand_clusters
+from hierarchical import hierarchical_cluster
+from manipulate_tweets import ManipulateTweet
+from synset_cache import SynsetCache
+from synthetic_tweets import write_corpus
+
+"""
+End-to-end benchmark of the topic detection pipeline.
+Generates synthetic capture files of the given sizes, times every stage and
+records its peak memory, and emits the results as JSON.
+"""
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+
+def run_size(manip_tweet, path, dense=False, cache=None, trace_memory=True,
+             mcl_options=None, dedup=None, partition_size=None):
+    """
+    Runs the pipeline on one capture file. Returns per-stage timings and
+    peak memory along with a summary of the result. `dedup` collapses
+    "exact" or "near" duplicates before tokenizing. With `partition_size`,
+    documents are clustered with `hierarchical_cluster` instead of one
+    global score matrix.
+    """
+    stages = {}
+
+    def measure(name, func):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        stages[name] = {"seconds": seconds}
+        if trace_memory:
+            stages[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return result
+
+    tweets_data = measure("load", lambda: list(
+        manip_tweet.iter_tweets_data(path)))
+    documents = measure("preprocess", lambda: list(
+        manip_tweet.preprocess_tweet(tweets_data)))
+    members = None
+    if dedup is not None:
+        documents, members = measure("deduplicate", lambda: deduplicate(
+            documents, near=dedup == "near"))
+    tokens = measure("tokenize", lambda: manip_tweet.tokenize_tweets(
+        documents, batch_size=1000))
+    sim = measure("tfidf", lambda: Similarity(tokens, cache=cache))
+    measure("feature_similarity", sim.feature_similarity)
+    node_weights = None if members is None else \
+        weights(members, tokens.doc_ids)
+    if partition_size is not None:
+        clusters = measure("hierarchical", lambda: hierarchical_cluster(
+            sim, partition_size, weights=node_weights, **(mcl_options or {})))
+    else:
+        score_matrix = measure("soft_cosine", lambda: sim.similarity(
+            sparse_output=not dense))
+        matrix = measure("mcl", lambda: mcl.cluster(score_matrix,
+                                                    weights=node_weights,
+                                                    **(mcl_options or {})))
+        clusters = measure("get_clusters", lambda: mcl.get_clusters(matrix))
+    if members is not None:
+        clusters = expand_clusters(clusters, members, tokens.doc_ids)
+
+    return {
+        "tweets": len(tweets_data),
+        "representatives": len(documents),
+        "documents": len(tokens),
+        "features": len(sim._features),
+        "clusters": len(clusters),
+        "stages": stages,
+        "total_seconds": sum(s["seconds"] for s in stages.values()),
+    }
+
+
+def run(sizes, seed=0, dense=False, cache_path=None, trace_memory=True,
+        directory=None, mcl_options=None, dedup=None, partition_size=None):
+    """
+    Benchmarks every corpus size and returns the results as a dict.
+    """
+    manip_tweet = ManipulateTweet()
+    cache = SynsetCache(cache_path) if cache_path else None
+    directory = directory or tempfile.mkdtemp(prefix="benchmark_")
+
+    results = []
+    for size in sizes:
+        path = os.path.join(directory, "synthetic_{}_{}.txt".format(size, seed))
+        if not os.path.exists(path):
+            write_corpus(path, size, seed)
+        result = run_size(manip_tweet, path, dense, cache, trace_memory,
+                          mcl_options, dedup, partition_size)
+        result["size"] = size
+        results.append(result)
+        print("[INFO] {} tweets: {:.2f}s".format(size, result["total_seconds"]),
+              file=sys.stderr)
+
+    if cache is not None:
+        cache.close()
+
+    return {
+        "seed": seed,
+        "dense": dense,
+        "mcl_options": mcl_options or {},
+        "dedup": dedup,
+        "partition_size": partition_size,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the pipeline on synthetic tweet corpora.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated corpus sizes, e.g. 100,1000")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dense", action="store_true",
+                        help="use dense score matrices instead of sparse")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="run dense MCL in float32 with in-place buffers")
+    parser.add_argument("--iter-count", type=int, default=10,
+                        help="maximum number of MCL iterations")
+    parser.add_argument("--top-k", type=int, default=None,
+                        help="entries kept per column by sparse MCL")
+    parser.add_argument("--dedup", choices=("exact", "near"), default=None,
+                        help="collapse duplicate tweets before clustering")
+    parser.add_argument("--partition-size", type=int, default=None,
+                        help="use two-level MCL with partitions of this size")
+    parser.add_argument("--cache", default=None,
+                        help="SynsetCache file to use; no cache by default")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip tracemalloc peak memory tracking")
+    parser.add_argument("--data-dir", default=None,
+                        help="directory where synthetic corpora are kept")
+    parser.add_argument("--output", default=None,
+                        help="JSON output file; stdout by default")
+    args = parser.parse_args()
+
+    report = run([int(size) for size in args.sizes.split(",")], args.seed,
+                 args.dense, args.cache, not args.no_memory, args.data_dir,
+                 {"iter_count": args.iter_count, "top_k": args.top_k,
+                  "low_memory": args.low_memory},
+                 args.dedup, args.partition_size)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,64 @@
+import re
+import argparse
+import timeit
+
+from manipulate_tweets import ManipulateTweet
+
+"""
+Micro-benchmark of tweet cleaning. Compares the previous four-pass cleaner
+with `ManipulateTweet._clean_tweet` and the bulk `clean_tweets` on the texts
+of a capture file.
+"""
+
+
+def legacy_clean_tweet(text):
+    """
+    Cleaner as it was before the patterns were precompiled and combined.
+    """
+    emoji_pattern = re.compile("["
+        "\U0001F600-\U0001F64F"  # emoticons
+        "\U0001F300-\U0001F5FF"  # symbols & pictographs
+        "\U0001F680-\U0001F6FF"  # transport & map symbols
+        "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+        "\u261E"                 # ☞ additional
+        "\u2026"                 # ellipsis
+    "]+", flags=re.UNICODE)
+    text = re.sub(r'https?://[^\s<>"]+|www\.[^\s<>"]+', '', text)
+    text = emoji_pattern.sub(r'', text)
+    text = re.sub(r'(RT )*@[^\s]*', '', text)
+    text = re.sub(r'&(.*);', '', text)
+    return text
+
+
+def run(path, repeat, number):
+    manip_tweet = ManipulateTweet()
+    texts = [t["text"] for t in manip_tweet.iter_tweets_data(path)] * repeat
+
+    expected = [legacy_clean_tweet(text) for text in texts]
+    assert [manip_tweet._clean_tweet(text) for text in texts] == expected
+    assert list(manip_tweet.clean_tweets(texts)) == expected
+
+    cases = [
+        ("legacy", lambda: [legacy_clean_tweet(text) for text in texts]),
+        ("_clean_tweet", lambda: [manip_tweet._clean_tweet(text)
+                                  for text in texts]),
+        ("clean_tweets", lambda: list(manip_tweet.clean_tweets(texts))),
+    ]
+    print("Texts: {}".format(len(texts)))
+    for name, func in cases:
+        best = min(timeit.repeat(func, repeat=3, number=number)) / number
+        print("{:<14} {:10.2f} ms  {:8.2f} us/tweet".format(
+            name, best * 1000, best * 1e6 / len(texts)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmarks tweet cleaning on a capture file.")
+    parser.add_argument("path", nargs="?", default="data/tweets_data_2.txt",
+                        help="capture file written by stream_tweets.py")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="times the texts of the file are repeated")
+    parser.add_argument("--number", type=int, default=5,
+                        help="runs per timing")
+    args = parser.parse_args()
+    run(args.path, args.repeat, args.number)
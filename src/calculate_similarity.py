@@ -1,15 +1,30 @@
+import os
 import re
 import math
+import shutil
+import tempfile
 import numpy as np
 
 from collections import defaultdict
+from multiprocessing import Pool
 from nltk.corpus import wordnet as wn
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfTransformer
 from sklearn.metrics.pairwise import cosine_similarity
 
+from instrumentation import metrics
+from score_file import ScoreFileWriter
+from shared_matrix import save_shared, load_shared
+from token_corpus import TokenCorpus
+
 
 
 THRESHOLD = 0.45
+# Upper bound on the feature scoring passes of `_score_features`.
+MAX_SCORING_PASSES = 10
+
+# Terms not matching this pattern, and hashtags, have no synsets.
+SYNSET_TERM_PATTERN = re.compile(r'^([a-zA-Z]+[-]?[a-zA-Z]+)$')
 
 
 class Similarity:
@@ -18,44 +33,402 @@ class Similarity:
     using WordNet's wup_similarity function for getting feature similarity
     score.
     """
-    def __init__(self, tokens):
+    def __init__(self, tokens=None, cache=None, index=None, vocabulary=None):
         """
         Similarity class constructor.
-        `document` - list of documents to be analyzed.
-        `manip_tweet` - class object instance of manipulate tweet module.
+        `tokens` - `TokenCorpus` of the documents to be analyzed. A dict of
+        token lists is converted to one.
+        `cache` - optional `SynsetCache` shared across runs.
+        `index` - optional `WordNetIndex`. If set, synsets are index ids and
+        are scored with array lookups instead of WordNet graph walks.
+        `vocabulary` - optional fitted `TfidfVocabulary`. If set, documents
+        are only transformed onto its features, and its saved feature
+        similarity matrix is used.
+        If `tokens` is None, no documents are vectorized and features are
+        added with `add_features`.
         """
-        self.tfidf = TfidfVectorizer(tokenizer=lambda keys: tokens[keys])
-        self.matrix = self.tfidf.fit_transform(tokens.keys())
-        self._features = self.tfidf.get_feature_names()
         self._synset_pairs = defaultdict(float)
         self._synsets = {}
+        self._cache = cache
+        self._index = index
+        self._feature_sim = None
+        self._semantic = []
+
+        if tokens is not None and not isinstance(tokens, TokenCorpus):
+            tokens = TokenCorpus.from_tokens(tokens.values())
+
+        if vocabulary is not None:
+            self.tfidf = vocabulary
+            self.matrix = None if tokens is None else \
+                vocabulary.transform(tokens)
+            self._features = vocabulary.features
+            self._feature_sim = vocabulary.feature_sim
+        elif tokens is None:
+            self.tfidf = None
+            self.matrix = None
+            self._features = []
+        else:
+            # Features are sorted like TfidfVectorizer sorts them.
+            order = sorted(range(len(tokens.vocabulary)),
+                           key=tokens.vocabulary.__getitem__)
+            self.tfidf = TfidfTransformer()
+            self.matrix = self.tfidf.fit_transform(tokens.counts()[:, order])
+            self._features = [tokens.vocabulary[i] for i in order]
+
+    @classmethod
+    def from_features(cls, features, feature_sim):
+        """
+        Creates a Similarity over already scored features, e.g. to compute
+        soft cosine scores of document matrices in another process.
+        """
+        similarity = cls()
+        similarity._features = list(features)
+        similarity._feature_sim = feature_sim
+        return similarity
 
-    def similarity(self, M1=None, M2=None):
+    def similarity(self, M1=None, M2=None, sparse_output=False, workers=None):
         """
         Calculates similarity measure of each document matrix. Uses soft cosine
         similarity measure to calculate document similarities.
+
+        The whole score matrix is computed at once as the normalized product
+        `M1 S M2^T`, where `S` is the thresholded feature similarity matrix.
+        If `sparse_output` is True, a scipy.sparse CSR matrix is returned.
+        If `workers` is set, the dense score matrix is computed in row blocks
+        by a pool of that many processes.
         """
         if M1 is None:
             M1 = self.matrix
             if M2 is None:
                 M2 = self.matrix
-        # Get the sum of consecutive integers for the size of the array
-        doc_sim = np.zeros([M1.shape[0], M2.shape[0]])
-        doc_pairs = defaultdict(float)
-        for i in range(M1.shape[0]):
-            for j in range(M2.shape[0]):
-                sorted_indices = tuple( sorted((i,j)) )
-                if sorted_indices in doc_pairs:
-                    doc_sim[i, j] = doc_pairs[sorted_indices]
-                else:
-                    if i == j:
-                        doc_sim[i, j] = 1
-                    else:
-                        doc_sim[i, j] = self._soft_cosine_measure(
-                            M1.getrow(i), M2.getrow(j))
-                        doc_pairs[sorted_indices] = doc_sim[i, j]
+        S = self.feature_similarity()
+        with metrics.timer("similarity.soft_cosine"):
+            return self._soft_cosine_matrix(M1, M2, S, sparse_output, workers)
+
+    def _soft_cosine_matrix(self, M1, M2, S, sparse_output, workers):
+        """
+        Computes the normalized `M1 S M2^T` score matrix for `similarity`.
+        """
+        M1_S = M1.dot(S)
+        denom1 = _soft_cosine_norms(M1, M1_S)
+        denom2 = _soft_cosine_norms(M2, M2.dot(S))
+
+        if workers is not None:
+            if sparse_output:
+                raise ValueError("workers is only supported for dense output")
+            doc_sim = self._parallel_similarity(M1, M2, S, denom1, denom2,
+                                                workers)
+        else:
+            product = M1_S.dot(M2.T)
+            if sparse_output:
+                product = sparse.diags(1 / denom1).dot(product).dot(
+                    sparse.diags(1 / denom2))
+                return self._mirror_sparse(product.tocoo())
+            doc_sim = product.toarray() / np.outer(denom1, denom2)
+
+        # Lower triangle mirrors the upper one, like the pairwise loop did
+        # when it reused already computed document pairs.
+        rows, cols = np.tril_indices(M1.shape[0], -1, M2.shape[0])
+        mirrored = rows < M2.shape[0]
+        rows, cols = rows[mirrored], cols[mirrored]
+        doc_sim[rows, cols] = doc_sim[cols, rows]
+        np.fill_diagonal(doc_sim, 1)
         return doc_sim
 
+    def similarity_to_file(self, path, M=None, block_size=1000,
+                           threshold=None):
+        """
+        Computes the soft cosine score matrix of M against itself in blocks
+        of `block_size` rows and writes it to a memory-mapped `ScoreFile` in
+        the `path` directory, which `mcl.cluster` can read block by block.
+        Like `similarity`, the lower triangle mirrors the upper one, so the
+        file is symmetric: each row's scores left of the diagonal are taken
+        from the upper triangle rows of the earlier documents.
+        Scores are stored as dense float32 unless `threshold` is set, in
+        which case only scores above it (and the diagonal) are kept in a
+        sparse file. Returns the `ScoreFile`.
+        """
+        if M is None:
+            M = self.matrix
+        S = self.feature_similarity()
+        size = M.shape[0]
+        writer = ScoreFileWriter(path, size, dense=threshold is None)
+        with metrics.timer("similarity.similarity_to_file"):
+            M = sparse.csr_matrix(M)
+            M_S = M.dot(S).tocsr()
+            inv_denom = 1 / _soft_cosine_norms(M, M_S)
+            # Upper triangle scores are M_S[i] . M[j] for i < j; the lower
+            # triangle of row i reuses them as M[i] . M_S[j] for j < i.
+            M_T = sparse.csc_matrix(M.T).dot(sparse.diags(inv_denom))
+            M_S_T = sparse.csc_matrix(M_S.T).dot(sparse.diags(inv_denom))
+            for start in range(0, size, block_size):
+                end = min(start + block_size, size)
+                scale = sparse.diags(inv_denom[start:end])
+                upper = scale.dot(M_S[start:end].dot(M_T[:, start:])).tocoo()
+                lower = scale.dot(M[start:end].dot(M_S_T[:, :end])).tocoo()
+                upper_keep = upper.row < upper.col
+                lower_keep = lower.row + start > lower.col
+                if threshold is not None:
+                    upper_keep &= upper.data > threshold
+                    lower_keep &= lower.data > threshold
+                rows = np.concatenate([upper.row[upper_keep],
+                                       lower.row[lower_keep],
+                                       np.arange(end - start)])
+                cols = np.concatenate([upper.col[upper_keep] + start,
+                                       lower.col[lower_keep],
+                                       np.arange(start, end)])
+                data = np.concatenate([upper.data[upper_keep],
+                                       lower.data[lower_keep],
+                                       np.ones(end - start)])
+                writer.write(sparse.csr_matrix((data, (rows, cols)),
+                                               shape=(end - start, size)))
+        return writer.close()
+
+    def candidate_pairs(self, M=None, max_df=1.0):
+        """
+        Blocking stage of `candidate_similarity`. Uses the documents' features,
+        expanded with their above-`THRESHOLD` neighbours in the feature
+        similarity matrix, as an inverted index. Returns row and column
+        indices (row < column) of the document pairs that share at least one
+        similar term; every other pair scores zero.
+        Features found in more than `max_df` of the documents are left out of
+        the index, so pairs that only share very common terms are skipped.
+        """
+        if M is None:
+            M = self.matrix
+        postings = sparse.csr_matrix(M, dtype=np.float32, copy=True)
+        postings.data[:] = 1
+        if max_df < 1.0:
+            df = np.asarray(postings.sum(axis=0)).ravel()
+            keep = (df <= max_df * M.shape[0]).astype(np.float32)
+            postings = postings.dot(sparse.diags(keep)).tocsr()
+            postings.eliminate_zeros()
+
+        neighbours = sparse.csr_matrix(self.feature_similarity(),
+                                       dtype=np.float32, copy=True)
+        neighbours.data[:] = 1
+        candidates = sparse.triu(postings.dot(neighbours).dot(postings.T), 1)
+        return candidates.row, candidates.col
+
+    def candidate_similarity(self, M=None, max_df=1.0, min_score=0.0,
+                             chunk_size=100000):
+        """
+        Soft cosine similarity computed only for the pairs returned by
+        `candidate_pairs`. Pairs scoring `min_score` or less are dropped.
+        Returns a symmetric scipy.sparse CSR matrix with a unit diagonal that
+        can be passed to `mcl.cluster`.
+        """
+        if M is None:
+            M = self.matrix
+        M = sparse.csr_matrix(M)
+        rows, cols = self.candidate_pairs(M, max_df)
+
+        with metrics.timer("similarity.candidate_similarity"):
+            M_S = M.dot(self.feature_similarity()).tocsr()
+            denom = _soft_cosine_norms(M, M_S)
+            scores = np.empty(len(rows))
+            for start in range(0, len(rows), chunk_size):
+                end = start + chunk_size
+                scores[start:end] = np.asarray(M_S[rows[start:end]].multiply(
+                    M[cols[start:end]]).sum(axis=1)).ravel()
+            scores /= denom[rows] * denom[cols]
+
+        metrics.gauge("similarity.candidate_pairs", len(rows))
+        keep = scores > min_score
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+        diagonal = np.arange(M.shape[0])
+        return sparse.csr_matrix(
+            (np.concatenate([scores, scores, np.ones(diagonal.size)]),
+             (np.concatenate([rows, cols, diagonal]),
+              np.concatenate([cols, rows, diagonal]))),
+            shape=(M.shape[0], M.shape[0]))
+
+    def _parallel_similarity(self, M1, M2, S, denom1, denom2, workers):
+        """
+        Computes the normalized score matrix in a process pool. Inputs are
+        saved to a temporary directory and memory-mapped by the workers, which
+        write their row blocks straight into a shared memory-mapped output.
+        Only the upper triangle (and rows without a mirrored counterpart) is
+        computed.
+        """
+        n1, n2 = M1.shape[0], M2.shape[0]
+        if n1 == 0 or n2 == 0:
+            return np.zeros((n1, n2))
+        directory = tempfile.mkdtemp(prefix="similarity_")
+        try:
+            save_shared(directory, "M1", sparse.csr_matrix(M1))
+            save_shared(directory, "S", sparse.csr_matrix(S))
+            save_shared(directory, "M2T", sparse.csr_matrix(M2.T))
+            np.save(os.path.join(directory, "denom1.npy"), denom1)
+            np.save(os.path.join(directory, "denom2.npy"), denom2)
+            np.memmap(os.path.join(directory, "out.dat"), dtype=np.float64,
+                      mode="w+", shape=(n1, n2)).flush()
+
+            # Splits rows into blocks of roughly equal numbers of pairs.
+            row_work = np.where(np.arange(n1) < n2, n2 - np.arange(n1), n2)
+            cumulative = np.cumsum(row_work)
+            bounds = np.searchsorted(
+                cumulative, np.linspace(0, cumulative[-1], workers * 4 + 1)[1:])
+            bounds = np.unique(np.concatenate([[0], bounds + 1, [n1]]))
+            bounds = bounds[bounds <= n1]
+            tasks = [(directory, int(start), int(end), n1, n2)
+                     for start, end in zip(bounds[:-1], bounds[1:])]
+
+            pool = Pool(workers)
+            try:
+                pool.map(_score_block, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+            out = np.memmap(os.path.join(directory, "out.dat"),
+                            dtype=np.float64, mode="r", shape=(n1, n2))
+            return np.array(out)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _mirror_sparse(self, M):
+        """
+        Sparse counterpart of the triangle mirroring in `similarity`. Takes a
+        COO score matrix and returns it as CSR with the lower triangle copied
+        from the upper one and a unit diagonal.
+        """
+        n1, n2 = M.shape
+        upper = M.row < M.col
+        mirrored = upper & (M.col < n1)
+        lower = (M.row > M.col) & (M.row >= n2)
+        diagonal = np.arange(min(n1, n2))
+
+        rows = np.concatenate([M.row[upper], M.col[mirrored], M.row[lower],
+                               diagonal])
+        cols = np.concatenate([M.col[upper], M.row[mirrored], M.col[lower],
+                               diagonal])
+        data = np.concatenate([M.data[upper], M.data[mirrored],
+                               M.data[lower], np.ones(diagonal.size)])
+        return sparse.csr_matrix((data, (rows, cols)), shape=(n1, n2))
+
+    def feature_similarity(self):
+        """
+        Builds the sparse feature x feature similarity matrix once. Same terms
+        have 1.0 similarity, other pairs keep their WordNet score only if it is
+        above `THRESHOLD`.
+        """
+        if self._feature_sim is None:
+            with metrics.timer("similarity.feature_similarity"):
+                indices = range(len(self._features))
+                self._feature_sim = self._score_features(indices, indices)
+        return self._feature_sim
+
+    def add_features(self, terms):
+        """
+        Appends new terms to the features and extends the feature similarity
+        matrix, scoring only the pairs that involve a new term.
+        """
+        S = self.feature_similarity()
+        old = range(len(self._features))
+        self._features = list(self._features) + list(terms)
+        new = range(len(old), len(self._features))
+
+        size = len(self._features)
+        indptr = np.concatenate([S.indptr,
+                                 np.repeat(S.indptr[-1], len(new))])
+        S = sparse.csr_matrix((S.data, S.indices, indptr), shape=(size, size))
+        self._feature_sim = (S + self._score_features(new, range(size)) +
+                             self._score_features(old, new)).tocsr()
+
+    def remove_features(self, keep):
+        """
+        Keeps only the features at the sorted indices `keep`, e.g. terms
+        still used by a sliding window, and forgets the cached synsets and
+        synset pair scores of the removed terms.
+        """
+        S = self.feature_similarity()
+        self._classify_features()
+        removed = set(self._features).difference(
+            self._features[i] for i in keep)
+        self._features = [self._features[i] for i in keep]
+        self._semantic = [self._semantic[i] for i in keep]
+        self._feature_sim = S[keep][:, keep]
+        for term in removed:
+            self._synsets.pop(term, None)
+        for pair in [pair for pair in self._synset_pairs
+                     if pair[0] in removed or pair[1] in removed]:
+            del self._synset_pairs[pair]
+
+    def _score_features(self, indices1, indices2):
+        """
+        Scores every feature pair of `indices1` x `indices2` in row-major order
+        and returns them as a sparse feature x feature matrix.
+        A pair scores 0 while only one of its terms has cached synsets, and
+        is not cached, so the old pairwise loop got different scores on
+        later passes over the features as `_synsets` filled up. Passes are
+        repeated until `_synsets` stops changing, which gives the scores of
+        that loop.
+        """
+        for i in range(MAX_SCORING_PASSES):
+            synsets = dict(self._synsets)
+            scores = self._score_pass(indices1, indices2)
+            if self._synsets == synsets:
+                break
+        else:
+            print("[WARNING] Synset cache still changing after {} "
+                  "passes".format(MAX_SCORING_PASSES))
+
+        if self._cache is not None:
+            self._cache.flush()
+        return scores
+
+    def _score_pass(self, indices1, indices2):
+        """
+        One row-major scoring pass of `_score_features`.
+        Opaque features (see `_classify_features`) always score 0 against
+        other features, so only their identity pairs are kept and WordNet
+        is only queried for pairs of WordNet-capable features.
+        """
+        self._classify_features()
+        semantic2 = [j for j in indices2 if self._semantic[j]]
+        rows, cols, data = [], [], []
+        for i in indices1:
+            if not self._semantic[i]:
+                if i in indices2:
+                    rows.append(i)
+                    cols.append(i)
+                    data.append(1)
+                continue
+
+            term1 = self._features[i]
+            for j in semantic2:
+                term2 = self._features[j]
+                if term1 == term2:
+                    feature_score = 1
+                else:
+                    feature_score = self._get_feature_score(term1, term2)
+                    if feature_score <= THRESHOLD:
+                        continue
+                rows.append(i)
+                cols.append(j)
+                data.append(feature_score)
+
+        size = len(self._features)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(size, size))
+
+    def _classify_features(self):
+        """
+        Classifies features not classified yet as WordNet-capable or opaque.
+        Opaque features are hashtags, terms that are not alphabetic words
+        and words without synsets, for which `_get_feature_score` returns 0
+        without caching anything.
+        """
+        for term in self._features[len(self._semantic):]:
+            semantic = "#" not in term and \
+                SYNSET_TERM_PATTERN.match(term) is not None
+            if semantic:
+                synsets = self._index.synset_ids(term) \
+                    if self._index is not None else wn.synsets(term)
+                semantic = len(synsets) > 0
+            self._semantic.append(semantic)
+        metrics.gauge("similarity.semantic_features", sum(self._semantic))
+
     def cos_similarity(self, M1=None, M2=None):
         '''
         Cosine similarity measure of documents. For testing purposes.
@@ -70,22 +443,7 @@ class Similarity:
         """
         Multiplies values between vector elements and similarity function scores.
         """
-        sum = 0
-        for i in range(v1.shape[0]):
-            for j in range(v1.shape[0]):
-
-                # Same terms has 1.0 similarity.
-                if self._features[i] == self._features[j]:
-                    feature_score = 1
-                else:
-                    feature_score = self._get_feature_score(self._features[i],
-                        self._features[j])
-
-                    if feature_score <= THRESHOLD:
-                        feature_score = 0
-
-                sum += v1[i] * v2[j] * feature_score
-        return sum
+        return self.feature_similarity().dot(v2).dot(v1)
 
     def _soft_cosine_measure(self, v1, v2):
         """
@@ -132,6 +490,44 @@ class Similarity:
 
             return tuple(best_pair)
 
+    def _get_best_synsets(self, term1, term2):
+        """
+        Gets best synsets of a term pair and their wup_similarity score. Reads
+        from and writes to the persistent cache if one is set.
+        """
+        if self._index is not None:
+            syn1, syn2 = self._index.best_synsets(term1, term2)
+            score = None
+            if syn1 is not None and syn2 is not None:
+                score = self._index.wup_similarity(syn1, syn2)
+            return syn1, syn2, score
+
+        if self._cache is not None:
+            cached = self._cache.get(term1, term2)
+            metrics.count("synset_cache.hits" if cached is not None
+                          else "synset_cache.misses")
+            if cached is not None:
+                return cached
+
+        with metrics.timer("wordnet.get_synsets"):
+            syn1, syn2 = self._get_synsets(term1, term2)
+            score = None
+            if syn1 is not None and syn2 is not None:
+                score = wn.wup_similarity(syn1, syn2)
+
+        if self._cache is not None:
+            self._cache.put(term1, term2, syn1, syn2, score)
+        return syn1, syn2, score
+
+    def _wup_similarity(self, syn1, syn2):
+        """
+        Wu-Palmer similarity of two synsets, or of two index ids if an index
+        is set.
+        """
+        if self._index is not None:
+            return self._index.wup_similarity(syn1, syn2)
+        return wn.wup_similarity(syn1, syn2)
+
     def _get_related_nouns(self, synset):
         """
         Gets derivationally related word forms as noun synsets of a given synset
@@ -155,7 +551,11 @@ class Similarity:
 
         # Checks if synset pair had already been calculated.
         if sorted_terms in self._synset_pairs:
+            if metrics.enabled:
+                metrics.count("synset_pairs.hits")
             return self._synset_pairs[tuple( sorted((term1, term2)) )]
+        if metrics.enabled:
+            metrics.count("synset_pairs.misses")
 
         # If a term contains a hashtag, it automatically does not contain
         # synsets, thus, returning 0.
@@ -164,7 +564,7 @@ class Similarity:
 
         # If a term has does not fully contains alpha characters, it has no
         # synsets.
-        if any(re.search(r'^([a-zA-Z]+[-]?[a-zA-Z]+)$', term) is None for term in (term1, term2)):
+        if any(SYNSET_TERM_PATTERN.match(term) is None for term in (term1, term2)):
             return 0
 
         # If the synset has already been captured. Checks the cache to get the
@@ -172,8 +572,12 @@ class Similarity:
         syn1 = self._synsets.get(term1)
         syn2 = self._synsets.get(term2)
 
+        score = None
         if all(syn is None for syn in (syn1, syn2)):
-            syn1, syn2 = self._get_synsets(term1, term2)
+            metrics.count("synsets.misses")
+            syn1, syn2, score = self._get_best_synsets(term1, term2)
+        else:
+            metrics.count("synsets.hits")
 
         # If one/both synset/s is/are not found in WordNet. If it's not found, its
         # value is None, otherwise, a Synset object.
@@ -185,7 +589,8 @@ class Similarity:
                 self._synsets[term2] = syn2
             return 0
 
-        score = wn.wup_similarity(syn1, syn2)
+        if score is None:
+            score = self._wup_similarity(syn1, syn2)
 
         if score is None:
             score = 0
@@ -194,6 +599,41 @@ class Similarity:
         return score
 
 
+def _soft_cosine_norms(M, M_S):
+    """
+    Soft cosine norms `sqrt(m S m^T)` of the rows of M, given `M_S = M S`.
+    Empty rows, e.g. documents without known features, get a norm of 1 so
+    they score 0 against other documents.
+    """
+    norms = np.sqrt(np.asarray(M_S.multiply(M).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return norms
+
+
+def _score_block(task):
+    """
+    Worker function of `Similarity._parallel_similarity`. Scores rows
+    `start`:`end` and writes them into the shared output matrix.
+    """
+    directory, start, end, n1, n2 = task
+    M1 = load_shared(directory, "M1")
+    S = load_shared(directory, "S")
+    M2T = load_shared(directory, "M2T")
+    denom1 = np.load(os.path.join(directory, "denom1.npy"), mmap_mode="r")
+    denom2 = np.load(os.path.join(directory, "denom2.npy"), mmap_mode="r")
+
+    # Columns left of the diagonal are mirrored later, unless the block has
+    # rows that have no mirrored counterpart.
+    col_start = start if end <= n2 else 0
+    block = M1[start:end].dot(S).dot(M2T[:, col_start:]).toarray()
+    block /= np.outer(denom1[start:end], denom2[col_start:])
+
+    out = np.memmap(os.path.join(directory, "out.dat"), dtype=np.float64,
+                    mode="r+", shape=(n1, n2))
+    out[start:end, col_start:] = block
+    out.flush()
+
+
 if __name__ == '__main__':
     tweets_data_path = "data/tweets_data.txt"
     documents = ["Praise the fucking sun!",
@@ -0,0 +1,70 @@
+import re
+
+import numpy as np
+
+"""
+Retweet and near-duplicate collapsing.
+Preprocessed tweets with the same normalized text (or, for near duplicates,
+the same set of words) are collapsed into one representative. The number of
+tweets each representative stands for is used as its weight in
+`mcl.cluster`, and clusters of representatives are expanded back to the
+original tweets afterwards.
+"""
+
+WORD_PATTERN = re.compile(r'\w+', flags=re.UNICODE)
+
+
+def normalize_text(text, near=False):
+    """
+    Returns the key tweets are grouped by: the lowercased words of the text,
+    or its sorted distinct words if `near` is True, so that tweets differing
+    only in case, punctuation, word order or repeated words collapse too.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    if near:
+        words = sorted(set(words))
+    return " ".join(words)
+
+
+def deduplicate(texts, near=False):
+    """
+    Collapses duplicate texts. Returns the representatives (the first text of
+    each group, in order of first appearance) and, for each representative,
+    the list of indices of the texts it stands for.
+    """
+    groups = {}
+    representatives, members = [], []
+    for i, text in enumerate(texts):
+        key = normalize_text(text, near)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = len(representatives)
+            representatives.append(text)
+            members.append([])
+        members[group].append(i)
+    return representatives, members
+
+
+def weights(members, doc_ids=None):
+    """
+    Multiplicity of each representative, as an array to pass to
+    `mcl.cluster`. `doc_ids` selects the representatives that were kept,
+    e.g. the `doc_ids` of a `TokenCorpus`.
+    """
+    counts = np.array([len(group) for group in members], dtype=float)
+    return counts if doc_ids is None else counts[np.asarray(doc_ids)]
+
+
+def expand_clusters(clusters, members, doc_ids=None):
+    """
+    Expands clusters of representatives to clusters of the original text
+    indices, in the format of `mcl.get_clusters`. If clusters index rows of
+    a `TokenCorpus`, its `doc_ids` map them to representatives.
+    """
+    expanded = []
+    for cluster in clusters:
+        if doc_ids is not None:
+            cluster = [doc_ids[i] for i in cluster]
+        expanded.append(tuple(sorted(i for group in cluster
+                                     for i in members[group])))
+    return sorted(expanded)
@@ -0,0 +1,230 @@
+import math
+
+import numpy as np
+
+from multiprocessing import Pool
+from scipy import sparse
+from scipy.sparse import csgraph
+from sklearn.cluster import MiniBatchKMeans
+
+import mcl
+
+from calculate_similarity import Similarity
+
+"""
+Two-level Markov clustering for corpora too large for one score matrix.
+Documents are first split into partitions with k-means over their TF-IDF
+vectors, keeping documents that share a hashtag together unless there are
+too many of them. Oversized partitions are split again, so each partition
+can be scored and clustered on its own with memory bounded by the
+partition size.
+Partition-level clusters are then merged by clustering the soft cosine
+scores of their centroids, weighted by their sizes.
+"""
+
+MERGE_THRESHOLD = 0.5
+# Partitions, and hashtag groups, may hold at most this many times the
+# average partition size.
+MAX_PARTITION_RATIO = 1.5
+
+
+def hashtag_groups(tokens):
+    """
+    Labels the documents of a `TokenCorpus` so that documents sharing a
+    hashtag get the same label. Documents without hashtags get labels of
+    their own.
+    """
+    hashtags = np.array([term.startswith("#") for term in tokens.vocabulary],
+                        dtype=bool)
+    counts = tokens.counts()
+    H = counts[:, np.nonzero(hashtags)[0]]
+    n = counts.shape[0]
+    # Bipartite document-hashtag graph; hashtag nodes come after documents.
+    graph = sparse.bmat([[None, H], [H.T, None]], format="csr") \
+        if H.shape[1] > 0 else sparse.csr_matrix((n, n))
+    return csgraph.connected_components(graph, directed=False)[1][:n]
+
+
+def partition(M, n_partitions, groups=None, seed=0, max_size=None):
+    """
+    Splits the rows of TF-IDF matrix M into `n_partitions` with k-means.
+    Rows with the same `groups` label are put in the same partition.
+    With `max_size`, groups larger than it are not kept together, and
+    partitions larger than it are split again with k-means until none is.
+    Returns the partition label of each row.
+    """
+    if groups is None:
+        groups = np.arange(M.shape[0])
+    groups = np.unique(groups, return_inverse=True)[1]
+    if max_size is None:
+        return _kmeans_partition(M, n_partitions, groups, seed)
+
+    large = np.bincount(groups, minlength=1)[groups] > max_size
+    if large.any():
+        groups[large] = groups.max() + 1 + np.arange(large.sum())
+    return _split_large(M, np.arange(M.shape[0]),
+                        _kmeans_partition(M, n_partitions, groups, seed),
+                        groups, max_size, seed)
+
+
+def _kmeans_partition(M, n_partitions, groups, seed):
+    """
+    k-means step of `partition`, keeping rows of a group together.
+    """
+    groups = np.unique(groups, return_inverse=True)[1]
+    n_groups = groups.max() + 1 if groups.size else 0
+    if n_partitions <= 1 or n_groups <= n_partitions:
+        return np.zeros(M.shape[0], dtype=np.int64) if n_partitions <= 1 \
+            else groups
+
+    G = sparse.csr_matrix((np.ones(groups.size),
+                           (groups, np.arange(groups.size))),
+                          shape=(n_groups, groups.size))
+    centroids = sparse.csr_matrix(G.dot(M))
+    norms = np.sqrt(np.asarray(centroids.multiply(centroids).sum(axis=1)))
+    norms[norms == 0] = 1
+    centroids = sparse.csr_matrix(centroids.multiply(1 / norms))
+    kmeans = MiniBatchKMeans(n_clusters=n_partitions, random_state=seed)
+    return kmeans.fit_predict(centroids)[groups]
+
+
+def _split_large(M, rows, labels, groups, max_size, seed):
+    """
+    Splits the partitions of `rows` larger than `max_size` into halves of
+    about `max_size` / 2 rows with k-means. If k-means cannot split one,
+    e.g. because its rows are identical, its groups are packed in order
+    instead. Returns partition labels numbered from 0.
+    """
+    result = np.empty(rows.size, dtype=np.int64)
+    n_labels = 0
+    for label in np.unique(labels):
+        members = np.nonzero(labels == label)[0]
+        if members.size <= max_size:
+            sub_labels = np.zeros(members.size, dtype=np.int64)
+        else:
+            n_parts = int(math.ceil(2.0 * members.size / max_size))
+            sub_labels = _kmeans_partition(M[rows[members]], n_parts,
+                                           groups[members], seed)
+            if np.unique(sub_labels).size > 1:
+                sub_labels = _split_large(M, rows[members], sub_labels,
+                                          groups[members], max_size, seed)
+            else:
+                sub_labels = _pack_groups(groups[members], max_size)
+        result[members] = sub_labels + n_labels
+        n_labels += sub_labels.max() + 1
+    return result
+
+
+def _pack_groups(groups, max_size):
+    """
+    Packs groups, each at most `max_size` rows, into consecutive
+    partitions of at most `max_size` rows.
+    """
+    unique, inverse, sizes = np.unique(groups, return_inverse=True,
+                                       return_counts=True)
+    packed = np.empty(unique.size, dtype=np.int64)
+    label, filled = 0, 0
+    for i, size in enumerate(sizes):
+        if filled + size > max_size:
+            label, filled = label + 1, 0
+        packed[i] = label
+        filled += size
+    return packed[inverse]
+
+
+def hierarchical_cluster(similarity, partition_size=2000, groups=None,
+                         merge_threshold=MERGE_THRESHOLD, workers=1, seed=0,
+                         weights=None, **mcl_options):
+    """
+    Clusters the documents of a `Similarity` in two levels and returns the
+    clusters in the format of `mcl.get_clusters`.
+    `partition_size` - average number of documents per partition. No
+    partition holds more than `MAX_PARTITION_RATIO` times as many.
+    `groups` - labels of documents to keep in one partition, e.g. from
+    `hashtag_groups`. Groups too large for one partition are split.
+    `merge_threshold` - centroid scores not above it are dropped before the
+    partition-level clusters are merged.
+    `workers` - number of processes clustering partitions in parallel.
+    `weights` - optional document weights, see `mcl.sparse_cluster`.
+    `mcl_options` - options passed to `mcl.cluster` at both levels.
+    """
+    M = similarity.matrix.tocsr()
+    n_partitions = int(math.ceil(M.shape[0] / float(partition_size)))
+    labels = partition(M, n_partitions, groups, seed,
+                       max(1, int(MAX_PARTITION_RATIO * partition_size)))
+    members = [np.nonzero(labels == label)[0] for label in np.unique(labels)]
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+    tasks = [(M[rows], None if weights is None else weights[rows], mcl_options)
+             for rows in members]
+
+    S = similarity.feature_similarity()
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(workers, initializer=_init_worker,
+                    initargs=(similarity._features, S))
+        try:
+            results = pool.map(_cluster_partition, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_cluster_partition(task, similarity) for task in tasks]
+
+    clusters = [rows[list(cluster)] for rows, partition_clusters
+                in zip(members, results) for cluster in partition_clusters]
+    if len(clusters) <= 1:
+        return sorted(tuple(cluster.tolist()) for cluster in clusters)
+    return _merge_clusters(similarity, M, clusters, merge_threshold,
+                           weights, mcl_options)
+
+
+def _merge_clusters(similarity, M, clusters, merge_threshold, weights,
+                    mcl_options):
+    """
+    Merges partition-level clusters by clustering their centroids, weighted
+    by the total weight of their documents.
+    """
+    lengths = [len(cluster) for cluster in clusters]
+    rows = np.concatenate(clusters)
+    C = sparse.csr_matrix(
+        (np.ones(rows.size) if weights is None else weights[rows],
+         (np.repeat(np.arange(len(clusters)), lengths), rows)),
+        shape=(len(clusters), M.shape[0]))
+    sizes = np.asarray(C.sum(axis=1)).ravel()
+    centroids = sparse.csr_matrix(C.dot(M))
+    scores = similarity.similarity(centroids, centroids,
+                                   sparse_output=True).tocoo()
+    keep = (scores.data > merge_threshold) | (scores.row == scores.col)
+    scores = sparse.csr_matrix(
+        (scores.data[keep], (scores.row[keep], scores.col[keep])),
+        shape=scores.shape)
+
+    matrix = mcl.cluster(scores, weights=sizes, **mcl_options)
+    merged = set()
+    for group in mcl.get_clusters(matrix):
+        merged.add(tuple(sorted(set(np.concatenate(
+            [clusters[i] for i in group]).tolist()))))
+    return sorted(merged)
+
+
+_worker_similarity = None
+
+
+def _init_worker(features, feature_sim):
+    """
+    Creates the `Similarity` of a partition worker process.
+    """
+    global _worker_similarity
+    _worker_similarity = Similarity.from_features(features, feature_sim)
+
+
+def _cluster_partition(args, similarity=None):
+    """
+    Scores and clusters the documents of one partition. Returns clusters of
+    row indices into the partition.
+    """
+    M, weights, mcl_options = args
+    similarity = similarity or _worker_similarity
+    scores = similarity.similarity(M, M, sparse_output=True)
+    return mcl.get_clusters(mcl.cluster(scores, weights=weights,
+                                        **mcl_options))
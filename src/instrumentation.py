@@ -0,0 +1,143 @@
+import json
+import time
+
+from contextlib import contextmanager
+
+"""
+Lightweight instrumentation for the topic detection pipeline.
+Timers, counters and gauges are recorded in the module-level `metrics`
+object and written to pluggable sinks. Recording is disabled by default and
+then costs a single attribute check.
+"""
+
+
+class Metrics:
+    """
+    Collects timers (total seconds and call counts), counters and gauges.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self.reset()
+
+    def enable(self, *sinks):
+        """
+        Enables recording. Metrics are written to `sinks` on `report`.
+        """
+        self.enabled = True
+        self.sinks = list(sinks)
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Times the enclosed block and adds it to the timer `name`.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            total, calls = self.timers.get(name, (0.0, 0))
+            self.timers[name] = (total + time.perf_counter() - start, calls + 1)
+
+    def count(self, name, value=1):
+        """
+        Adds `value` to the counter `name`.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets the gauge `name` to `value`.
+        """
+        if self.enabled:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        Returns the recorded metrics as a dict.
+        """
+        return {
+            "timers": {name: {"seconds": total, "calls": calls}
+                       for name, (total, calls) in self.timers.items()},
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+        }
+
+    def report(self):
+        """
+        Writes the recorded metrics to every sink.
+        """
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.write(snapshot)
+
+
+class LogSink:
+    """
+    Prints one line per metric.
+    """
+    def write(self, snapshot):
+        for name, timer in sorted(snapshot["timers"].items()):
+            print("[METRICS] {}: {:.6f}s ({} calls)".format(
+                name, timer["seconds"], timer["calls"]))
+        for kind in ("counters", "gauges"):
+            for name, value in sorted(snapshot[kind].items()):
+                print("[METRICS] {}: {}".format(name, value))
+
+
+class JSONSink:
+    """
+    Writes metrics to a JSON file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, snapshot):
+        with open(self.path, "w") as output:
+            json.dump(snapshot, output, indent=2)
+
+
+class PrometheusSink:
+    """
+    Writes metrics to a file in the Prometheus text exposition format.
+    """
+    def __init__(self, path, prefix="topic_detection"):
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, snapshot):
+        lines = []
+        for name, timer in sorted(snapshot["timers"].items()):
+            metric = self._name(name)
+            lines.append("# TYPE {}_seconds_total counter".format(metric))
+            lines.append("{}_seconds_total {}".format(metric, timer["seconds"]))
+            lines.append("# TYPE {}_calls_total counter".format(metric))
+            lines.append("{}_calls_total {}".format(metric, timer["calls"]))
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = self._name(name)
+            lines.append("# TYPE {}_total counter".format(metric))
+            lines.append("{}_total {}".format(metric, value))
+        for name, value in sorted(snapshot["gauges"].items()):
+            metric = self._name(name)
+            lines.append("# TYPE {} gauge".format(metric))
+            lines.append("{} {}".format(metric, float(value)))
+        with open(self.path, "w") as output:
+            output.write("\n".join(lines) + "\n")
+
+    def _name(self, name):
+        return "{}_{}".format(self.prefix, name.replace(".", "_"))
+
+
+metrics = Metrics()
@@ -1,10 +1,18 @@
+from itertools import islice
+
 import mcl
 
 from calculate_similarity import Similarity
+from deduplicate import deduplicate, weights, expand_clusters
+from instrumentation import metrics, LogSink
 from manipulate_tweets import ManipulateTweet
+from synset_cache import SynsetCache
+
 
+def run(instrument=False):
+    if instrument:
+        metrics.enable(LogSink())
 
-def run():
     documents = [
         "Apple is looking at buying U.K. startup for $1 billion",
         "Autonomous cars shift insurance liability toward manufacturers",
@@ -31,20 +39,35 @@ def run():
 
     manip_tweet = ManipulateTweet()
 
-    tweets_data = manip_tweet.load_tweets_data(tweets_data_path)
-    documents_3 = manip_tweet.preprocess_tweet(tweets_data)
-
-    #tokens = manip_tweet.tokenize_tweets(documents_3[100:200])
-    tokens = manip_tweet.tokenize_tweets(documents2)
-
-    for k, v in tokens.items():
-        print("{} [{}]\n========".format(k, v))
-
-    sim = Similarity(tokens)
-    #score_matrix = sim.cos_similarity() # Cosine similarity
-    score_matrix = sim.similarity()    # Soft cosine similarity
-    matrix = mcl.cluster(score_matrix, iter_count=100)
-    clusters = mcl.get_clusters(matrix)
+    with metrics.timer("stage.load_preprocess"):
+        tweets_data = manip_tweet.iter_tweets_data(tweets_data_path)
+        documents_3 = manip_tweet.preprocess_tweet(tweets_data)
+
+    with metrics.timer("stage.deduplicate"):
+        #documents, members = deduplicate(islice(documents_3, 100, 200))
+        documents, members = deduplicate(documents2)
+
+    with metrics.timer("stage.tokenize"):
+        tokens = manip_tweet.tokenize_tweets(documents)
+
+    for doc_id, v in zip(tokens.doc_ids, tokens):
+        print("{} [{}]\n========".format(documents[doc_id], v))
+
+    cache = SynsetCache()
+    with metrics.timer("stage.tfidf"):
+        sim = Similarity(tokens, cache=cache)
+    with metrics.timer("stage.similarity"):
+        #score_matrix = sim.cos_similarity() # Cosine similarity
+        score_matrix = sim.similarity()    # Soft cosine similarity
+        #score_matrix = sim.similarity(sparse_output=True) # Sparse MCL input
+        #score_matrix = sim.similarity_to_file("data/scores", threshold=0.1) # Out-of-core MCL input
+    cache.close()
+    with metrics.timer("stage.mcl"):
+        matrix = mcl.cluster(score_matrix, iter_count=100,
+                             weights=weights(members, tokens.doc_ids))
+    with metrics.timer("stage.get_clusters"):
+        clusters = expand_clusters(mcl.get_clusters(matrix), members,
+                                   tokens.doc_ids)
 
     #print("Features:\n", sim._features)
     #print("Matrix:\n", score_matrix)
@@ -53,6 +76,8 @@ def run():
     print("No. of Clusters: \n", len(clusters))
     print("No. of Features: \n", len(sim._features))
 
+    metrics.report()
+
 
 
 
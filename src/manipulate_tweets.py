@@ -1,10 +1,41 @@
 import re
+import gzip
 import json
 
-from collections import OrderedDict
+from itertools import islice
+from multiprocessing import Pool
 from spacy.lang.en import English
 
 from stop_words import STOP_WORDS
+from token_corpus import TokenCorpus
+
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
+
+
+TWEET_FIELDS = ("id_str", "created_at", "text")
+
+HASHTAG_PATTERN = re.compile(r'#\w+', flags=re.IGNORECASE)
+TOKEN_FILTER_PATTERN = re.compile(r'[\[\];\'\":<>,./?=+-_\)\(*&^%$@!~`\\|\{\}]')
+
+LINK_EMOJI_PATTERN = re.compile(
+    r'https?://[^\s<>"]+|www\.[^\s<>"]+|'
+    "["
+    "\U0001F600-\U0001F64F"  # emoticons
+    "\U0001F300-\U0001F5FF"  # symbols & pictographs
+    "\U0001F680-\U0001F6FF"  # transport & map symbols
+    "\U0001F1E0-\U0001F1FF"  # flags (iOS)
+    "\u261E"                 # ☞ additional
+    "\u2026"                 # ellipsis
+    "]+", flags=re.UNICODE)
+MENTION_PATTERN = re.compile(r'(RT )*@[^\s]*')
+HTML_PATTERN = re.compile(r'&(.*);')
+
+# No cleaning pattern matches across a newline, so texts joined by this
+# separator are cleaned exactly like separate texts.
+BATCH_SEPARATOR = "\n\x00\n"
 
 
 class ManipulateTweet:
@@ -14,21 +45,53 @@ class ManipulateTweet:
 
     def __init__(self):
         self.nlp = English()
+        self.load_stats = {"loaded": 0, "corrupt": 0, "incomplete": 0}
 
     def load_tweets_data(self, path):
         """
         Loads tweet data from the specified path.
         """
-        tweets_data = []
-        tweets_file = open(path, "r")
-        for line in tweets_file:
-            try:
-                tweet = json.loads(line)
-                tweets_data.append(tweet)
-            except:
-                continue
+        return list(self.iter_tweets_data(path, fields=None))
 
-        return tweets_data
+    def iter_tweets_data(self, path, fields=TWEET_FIELDS, fast_parser=True):
+        """
+        Lazily loads tweet data from the specified path, one line at a time.
+        Yields dicts with only the given `fields` of each tweet, or the full
+        tweet if `fields` is None. Uses ujson if it is installed and
+        `fast_parser` is True.
+        Lines that are not valid JSON are counted as corrupt, and tweets that
+        lack a projected field (e.g. limit or delete notices) as incomplete.
+        Counts are kept in `load_stats`. Gzipped captures (.gz) are read
+        as is.
+        """
+        loads = fast_json.loads if fast_parser and fast_json else json.loads
+        stats = {"loaded": 0, "corrupt": 0, "incomplete": 0}
+        self.load_stats = stats
+
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as tweets_file:
+            for line in tweets_file:
+                if not line.strip():
+                    continue
+                try:
+                    tweet = loads(line)
+                except ValueError:
+                    stats["corrupt"] += 1
+                    continue
+
+                if fields is not None:
+                    if not isinstance(tweet, dict) or \
+                            any(field not in tweet for field in fields):
+                        stats["incomplete"] += 1
+                        continue
+                    tweet = {field: tweet[field] for field in fields}
+
+                stats["loaded"] += 1
+                yield tweet
+
+        if stats["corrupt"] or stats["incomplete"]:
+            print("[WARNING] {}: skipped {} corrupt and {} incomplete "
+                  "lines".format(path, stats["corrupt"], stats["incomplete"]))
 
     def preprocess_tweet(self, tweet_data):
         """
@@ -36,16 +99,17 @@ class ManipulateTweet:
             1. Removes URLs
             2. Removes emojis and special characters
             3. Removes "RT"'s and @ symbols indicating mentions
+        Returns a generator, so tweets streamed from `iter_tweets_data` are
+        cleaned and can be tokenized one batch at a time.
         """
-        tweets = [self._clean_tweet(t["text"]) for t in tweet_data.__iter__()]
-        return tweets
+        return self.clean_tweets(t["text"] for t in tweet_data.__iter__())
 
     def _merge_hashtags(self, tweet, tokens):
         """
         Utility function to find and merge hashtag and words next to it as
         tokens.
         """
-        indices = [match.span() for match in re.finditer('#\w+', tweet, flags=re.IGNORECASE)]
+        indices = [match.span() for match in HASHTAG_PATTERN.finditer(tweet)]
         for start, end in indices:
             tokens.merge(start_idx=start, end_idx=end)
         return tokens
@@ -55,55 +119,126 @@ class ManipulateTweet:
         Tokenizes tweet, removes stopwords and punctuations and returns list of
         tokens.
         """
-        tokens = self.nlp(tweet)
+        return self._filter_tokens(tweet, self.nlp(tweet))
+
+    def _filter_tokens(self, tweet, tokens):
+        """
+        Merges hashtags of a parsed tweet, removes stopwords and punctuations
+        and returns list of tokens.
+        """
         tokens = self._merge_hashtags(tweet, tokens)
         tokens = [i.norm_ for i in tokens if not i.is_punct and \
-                re.search(r'[\[\];\'\":<>,./?=+-_\)\(*&^%$@!~`\\|\{\}]', i.norm_) is None and \
+                TOKEN_FILTER_PATTERN.search(i.norm_) is None and \
                 i.norm_ not in STOP_WORDS                   and \
                 "'" != i.norm_[0]                           and \
                 i.is_ascii                                  and \
                 not i.is_space]
         return tokens if tokens != [] else None
 
-    def tokenize_tweets(self, tweet_data):
+    def tokenize_tweets(self, tweet_data, batch_size=None, n_process=1):
         """
-        Tokenizes tweet data and converts it to dict (to be accessed properly
-        in other modules). With document as keys and tokens as values.
+        Tokenizes tweet data and returns it as a `TokenCorpus`. The doc id of
+        each tokenized tweet is its position in `tweet_data`; tweets without
+        tokens are left out.
+        If `batch_size` is set, tweets are parsed in batches with `nlp.pipe`,
+        split over `n_process` processes.
         """
-        tokens = OrderedDict()
-        for tweet in tweet_data.__iter__():
-            tokenized = self._tokenize(tweet)
+        if batch_size is None:
+            tokenized_tweets = ((tweet, self._tokenize(tweet))
+                                for tweet in tweet_data.__iter__())
+        elif n_process > 1:
+            tokenized_tweets = self._tokenize_parallel(tweet_data, batch_size,
+                                                       n_process)
+        else:
+            tokenized_tweets = self._tokenize_batch(tweet_data, batch_size)
+
+        tokens = TokenCorpus()
+        for doc_id, (tweet, tokenized) in enumerate(tokenized_tweets):
             if tokenized is not None:
-                tokens[tweet.lower()] = tokenized
+                tokens.append(tokenized, doc_id)
         return tokens
 
+    def _tokenize_batch(self, tweet_data, batch_size):
+        """
+        Tokenizes tweets with `nlp.pipe`. Yields tweets and their tokens.
+        """
+        for doc in self.nlp.pipe(tweet_data, batch_size=batch_size):
+            yield doc.text, self._filter_tokens(doc.text, doc)
+
+    def _tokenize_parallel(self, tweet_data, batch_size, n_process):
+        """
+        Tokenizes tweets in a pool of processes, each with its own spaCy
+        pipeline, one `batch_size` chunk per process at a time. Yields tweets
+        and their tokens in input order.
+        """
+        tweet_data = iter(tweet_data)
+        pool = Pool(n_process, initializer=_init_worker)
+        try:
+            while True:
+                chunks = [list(islice(tweet_data, batch_size))
+                          for i in range(n_process)]
+                chunks = [chunk for chunk in chunks if chunk]
+                if not chunks:
+                    break
+                results = pool.map(_tokenize_chunk,
+                                   [(chunk, batch_size) for chunk in chunks])
+                for chunk, tokenized in zip(chunks, results):
+                    for item in zip(chunk, tokenized):
+                        yield item
+        finally:
+            pool.close()
+            pool.join()
+
+    def clean_tweets(self, texts, batch_size=1000):
+        """
+        Cleans texts in bulk. Takes a list or an iterator of texts and yields
+        cleaned texts in the same order. Each batch of `batch_size` texts is
+        joined into one string, so every cleaning pattern runs once per batch.
+        """
+        texts = iter(texts)
+        while True:
+            batch = list(islice(texts, batch_size))
+            if not batch:
+                break
+
+            # Texts with a null character could form a separator once
+            # cleaned, so such batches are cleaned one text at a time.
+            if any("\x00" in text for text in batch):
+                cleaned = [self._clean_tweet(text) for text in batch]
+            else:
+                joined = BATCH_SEPARATOR.join(batch)
+                cleaned = self._clean_tweet(joined).split(BATCH_SEPARATOR)
+
+            for text in cleaned:
+                yield text
+
     def _clean_tweet(self, text):
-        text = self._remove_link(text)
-        text = self._remove_emojis(text)
-        text = self._remove_mentions(text)
-        text = self._remove_html_characters(text)
+        """
+        Removes links and emojis in one pass, then mentions and HTML
+        characters. Mentions and HTML characters need their own passes
+        because a removed mention may contain part of an HTML entity match.
+        """
+        text = LINK_EMOJI_PATTERN.sub('', text)
+        text = MENTION_PATTERN.sub('', text)
+        text = HTML_PATTERN.sub('', text)
 
         return text
 
-    def _remove_emojis(self, text):
-        emoji_pattern = re.compile("["
-            "\U0001F600-\U0001F64F"  # emoticons
-            "\U0001F300-\U0001F5FF"  # symbols & pictographs
-            "\U0001F680-\U0001F6FF"  # transport & map symbols
-            "\U0001F1E0-\U0001F1FF"  # flags (iOS)
-            "\u261E"                 # ☞ additional
-            "\u2026"                 # ellipsis
-        "]+", flags=re.UNICODE)
-        return emoji_pattern.sub(r'', text)
-
-    def _remove_link(self, text):
-        regex = r'https?://[^\s<>"]+|www\.[^\s<>"]+'
-        return re.sub(regex, '', text)
-
-    def _remove_mentions(self, text):
-        regex = r'(RT )*@[^\s]*'
-        return re.sub(regex, '', text)
-
-    def _remove_html_characters(self, text):
-        regex = r'&(.*);'
-        return re.sub(regex, '', text)
+_worker_tweet = None
+
+
+def _init_worker():
+    """
+    Creates the spaCy pipeline of a tokenizer worker process.
+    """
+    global _worker_tweet
+    _worker_tweet = ManipulateTweet()
+
+
+def _tokenize_chunk(args):
+    """
+    Worker function of `ManipulateTweet._tokenize_parallel`.
+    """
+    tweets, batch_size = args
+    return [tokens for tweet, tokens in
+            _worker_tweet._tokenize_batch(tweets, batch_size)]
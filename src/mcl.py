@@ -1,6 +1,15 @@
+import os
 import math
+import shutil
+import tempfile
 import numpy as np
 
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from instrumentation import metrics
+from score_file import ScoreFile, ScoreFileWriter
+
 """
 Markov Clustering Algorithm (MCL Algorithm) Implementation.
 Visit https://micans.org/mcl/index.html for more details about MCL.
@@ -19,11 +28,14 @@ def expand(M, power):
     """
     return np.linalg.matrix_power(M, power)
 
-def inflate(M, power):
+def inflate(M, power, weights=None):
     """
     Applies inflation process to the matrix with the given power.
     """
-    return normalize(np.power(M, power))
+    M = np.power(M, power)
+    if weights is not None:
+        M = M * _inflation_weights(weights, power)[:, np.newaxis]
+    return normalize(M)
 
 def check_convergence(M1, M2):
     """
@@ -44,21 +56,350 @@ def prune(M, threshold):
 def get_clusters(M):
     """
     Gets clusters generated by `cluster` function which performs MCL Algorithm.
+    Returns the sorted distinct attractor rows as tuples of column indices.
+    """
+    attractors, rows = _attractor_rows(M)
+    if len(attractors) == 0:
+        return []
+
+    # Two attractor rows are the same cluster when their overlap is as large
+    # as both of them.
+    binary = _binary(rows)
+    sizes = np.diff(binary.indptr)
+    shared = binary.dot(binary.T).tocoo()
+    same = (shared.data == sizes[shared.row]) & \
+        (shared.data == sizes[shared.col])
+    n_groups, groups = csgraph.connected_components(sparse.csr_matrix(
+        (shared.data[same], (shared.row[same], shared.col[same])),
+        shape=shared.shape), directed=False)
+    first = np.unique(groups, return_index=True)[1]
+
+    return sorted(tuple(binary.indices[binary.indptr[i]:
+                                       binary.indptr[i + 1]].tolist())
+                  for i in first)
+
+def cluster_labels(M, overlap="merge"):
+    """
+    Gets a cluster label per node from the result of `cluster`. Returns the
+    label array, where nodes no attractor reaches are labeled -1, and the
+    array of cluster sizes.
+    Nodes reached by attractors of different clusters overlap. With
+    `overlap` "merge", clusters sharing a node are merged into one connected
+    component of the attractor graph; with "split", each node goes to the
+    cluster of the attractor with the largest flow to it.
+    """
+    if overlap not in ("merge", "split"):
+        raise ValueError("overlap must be 'merge' or 'split'")
+    attractors, rows = _attractor_rows(M)
+    size = M.shape[0]
+    labels = np.full(size, -1, dtype=np.int64)
+    if len(attractors) == 0:
+        return labels, np.zeros(0, dtype=np.int64)
+
+    rows = rows.tocoo()
+    if overlap == "merge":
+        # Edges join each attractor to the nodes it reaches.
+        graph = sparse.csr_matrix(
+            (np.ones(rows.nnz), (attractors[rows.row], rows.col)),
+            shape=(size, size))
+        components = csgraph.connected_components(graph, directed=False)[1]
+        reached = np.zeros(size, dtype=bool)
+        reached[rows.col] = True
+        reached[attractors] = True
+        labels[reached] = components[reached]
+    else:
+        # Attractors reaching each other form one cluster.
+        reach = sparse.csr_matrix((np.ones(rows.nnz), (rows.row, rows.col)),
+                                  shape=(len(attractors), size))
+        components = csgraph.connected_components(
+            reach[:, attractors], directed=False)[1]
+        flows = sparse.csr_matrix((rows.data, (rows.col, rows.row)),
+                                  shape=(size, len(attractors)))
+        reached = np.diff(flows.indptr) > 0
+        strongest = np.asarray(flows.argmax(axis=1)).ravel()
+        labels[reached] = components[strongest[reached]]
+
+    # Relabels clusters 0..n-1 in order of their first node.
+    assigned = labels >= 0
+    first, inverse = np.unique(labels[assigned], return_index=True,
+                               return_inverse=True)[1:]
+    order = np.argsort(np.argsort(first))
+    labels[assigned] = order[inverse]
+    return labels, np.bincount(labels[assigned], minlength=len(first))
+
+def _attractor_rows(M):
+    """
+    Returns the attractors (nodes with a nonzero diagonal) of a clustered
+    matrix and their rows as a CSR matrix without explicit zeros.
+    """
+    if sparse.issparse(M):
+        M = M.tocsr()
+        attractors = M.diagonal().nonzero()[0]
+        rows = M[attractors]
+        rows.eliminate_zeros()
+    else:
+        M = np.asarray(M)
+        attractors = M.diagonal().nonzero()[0]
+        rows = sparse.csr_matrix(M[attractors])
+    rows.sort_indices()
+    return attractors, rows
+
+def _binary(M):
+    """
+    Returns a copy of sparse matrix M with every stored entry set to 1.
+    """
+    M = M.copy()
+    M.data = np.ones_like(M.data)
+    return M
+
+def sparse_normalize(M):
+    """
+    Normalizes sparse matrix to get transition matrix. Returns a CSC copy.
+    """
+    M = sparse.csc_matrix(M, dtype=float, copy=True)
+    sums = np.asarray(M.sum(axis=0)).ravel()
+    sums[sums == 0] = 1
+    M.data /= np.repeat(sums, np.diff(M.indptr))
+    return M
+
+def sparse_expand(M, power, threshold, top_k=None, block_size=1024):
+    """
+    Applies expansion process to the sparse matrix with the given power.
+    Columns are expanded in blocks and each block is pruned right away, so
+    the full unpruned product is never held in memory.
+    """
+    blocks = []
+    for start in range(0, M.shape[1], block_size):
+        block = M[:, start:start + block_size]
+        for i in range(power - 1):
+            block = M.dot(block)
+        blocks.append(sparse_prune(block, threshold, top_k))
+    return sparse.hstack(blocks, format='csc')
+
+def sparse_inflate(M, power, weights=None):
+    """
+    Applies inflation process to the sparse matrix with the given power.
+    """
+    M = M.power(power)
+    if weights is not None:
+        M = sparse.diags(_inflation_weights(weights, power)).dot(M)
+    return sparse_normalize(M)
+
+def check_sparse_convergence(M1, M2, rtol=1e-05, atol=1e-08):
+    """
+    Checks for convergence in the sparse matrix. Same tolerance as
+    `np.allclose`, computed on the sparse difference of M1 and M2.
+    """
+    delta = abs(M1 - M2) - rtol * abs(M2)
+    return delta.nnz == 0 or delta.max() <= atol
+
+def sparse_prune(M, threshold, top_k=None):
+    """
+    Prunes each column of the sparse matrix, removing entries lower than the
+    pruning threshold and keeping at most `top_k` of the largest entries.
     """
-    # Gets the attractors in the clustered graph.
-    attractor_list = M.diagonal().nonzero()[0]
+    M = sparse.csc_matrix(M)
+    if threshold > 0:
+        M.data[M.data < threshold] = 0
+        M.eliminate_zeros()
 
-    cluster_set = set()
+    counts = np.diff(M.indptr)
+    if top_k is not None and M.nnz > 0 and counts.max() > top_k:
+        # Ranks entries inside their column from largest to smallest.
+        columns = np.repeat(np.arange(M.shape[1]), counts)
+        order = np.lexsort((-M.data, columns))
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size) - M.indptr[columns[order]]
+        M.data[rank >= top_k] = 0
+        M.eliminate_zeros()
+    return M
 
-    # Puts graph vertices in cluster set.
-    for attractor in attractor_list:
-        cluster = tuple(M[attractor].nonzero()[0].tolist())
-        cluster_set.add(cluster)
+def sparse_cluster(M, exp_power=2, inf_power=2, iter_count=10,
+                   pr_threshold=0.0001, top_k=None, init=None, init_weight=0.5,
+                   weights=None):
+    """
+    Performs Markov Clustering Algorithm on a scipy.sparse matrix.
+    Clusters matrix with the following steps:
+        1. Normalizes matrix.
+        2. While iteration count not reached or convergence not met:
+            2.1. Expand matrix, pruning each column during expansion.
+            2.2. Inflate matrix and normalize.
+    `init` warm-starts the iterations from a previous result of the same
+    shape, blended with the normalized matrix by `init_weight`.
+    `weights` - optional node weights, e.g. duplicate counts. Node i is
+    clustered like weights[i] identical copies of it would be: its row is
+    scaled by weights[i] before normalizing, and by weights[i]^(1 - inf_power)
+    on inflation, where the copies' equal shares would be inflated apart.
+    """
+    if weights is not None:
+        M = sparse.diags(np.asarray(weights, dtype=float)).dot(M)
+    M = sparse_normalize(M)
+    if init is not None:
+        M = sparse_normalize((1 - init_weight) * M +
+                             init_weight * sparse.csc_matrix(init))
+    converged = False
+    with metrics.timer("mcl.cluster"):
+        for i in range(iter_count):
+            prev_mat = M
+            M = sparse_expand(M, exp_power, pr_threshold, top_k)
+            metrics.gauge("mcl.nnz", M.nnz)
+            M = sparse_inflate(M, inf_power, weights)
+
+            if check_sparse_convergence(M, prev_mat):
+                converged = True
+                break
+
+    metrics.gauge("mcl.iterations", i + 1 if iter_count > 0 else 0)
+    metrics.gauge("mcl.converged", converged)
+    return M
+
+def score_file_cluster(scores, exp_power=2, inf_power=2, iter_count=10,
+                       pr_threshold=0.0001, top_k=None, block_size=256,
+                       chunk_size=256):
+    """
+    Performs Markov Clustering Algorithm on a symmetric `ScoreFile` without
+    loading it whole. Every iteration is computed out of core: the matrix
+    is kept column-wise in a temporary sparse `ScoreFile` next to `scores`,
+    and each block of `block_size` columns is expanded by reading the
+    columns it needs `chunk_size` at a time, then pruned, inflated and
+    written to the next iteration's file.
+    Peak memory grows with the number of documents times `block_size` and
+    `chunk_size`, not with the square of the number of documents. Only the
+    final, pruned matrix is loaded and returned.
+    """
+    if iter_count < 1:
+        raise ValueError("iter_count must be at least 1 for score files")
+    size = scores.shape[0]
+    # Column j of the normalized matrix is row j of the symmetric file
+    # divided by its sum.
+    sums = scores.sums.copy()
+    sums[sums == 0] = 1
+    columns = (scores, 1 / sums)
+    work_dir = tempfile.mkdtemp(prefix="mcl_", dir=scores.path)
+    converged = False
+    try:
+        with metrics.timer("mcl.cluster"):
+            for i in range(iter_count):
+                # Files of two iterations ago are not read anymore.
+                path = os.path.join(work_dir, "iteration_{}".format(i % 2))
+                shutil.rmtree(path, ignore_errors=True)
+                writer = ScoreFileWriter(path, size)
+                converged = True
+                nnz = 0
+                for start in range(0, size, block_size):
+                    indices = np.arange(start, min(start + block_size, size))
+                    prev_block = _read_columns(columns, indices).T.tocsr()
+                    block = prev_block
+                    for j in range(exp_power - 1):
+                        block = _expand_block(columns, block, chunk_size)
+                    block = sparse_prune(block, pr_threshold, top_k)
+                    nnz += block.nnz
+                    block = sparse_inflate(block, inf_power)
+                    converged &= check_sparse_convergence(block, prev_block)
+                    writer.write(block.T)
+                columns = (writer.close(), None)
+                metrics.gauge("mcl.nnz", nnz)
+                if converged:
+                    break
+
+            M = _read_columns(columns, np.arange(size)).T.tocsc()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    metrics.gauge("mcl.iterations", i + 1)
+    metrics.gauge("mcl.converged", converged)
+    return M
+
+def _read_columns(columns, indices):
+    """
+    Reads columns of an out-of-core matrix as the rows of a CSR matrix.
+    `columns` is a (`ScoreFile`, scale) pair; the file's rows are the
+    matrix columns, multiplied by scale[j] unless scale is None.
+    """
+    scores, scale = columns
+    rows = scores.rows(indices)
+    if scale is not None:
+        rows = sparse.diags(scale[indices]).dot(rows)
+    return rows
+
+def _expand_block(columns, block, chunk_size):
+    """
+    Multiplies an out-of-core matrix by a block of its columns. Only the
+    columns matching the block's nonzero rows are read, `chunk_size` at a
+    time, and their products are summed.
+    """
+    neighbours = np.nonzero(np.diff(block.indptr))[0]
+    product = sparse.csr_matrix(block.shape)
+    for start in range(0, len(neighbours), chunk_size):
+        chunk = neighbours[start:start + chunk_size]
+        product = product + _read_columns(columns, chunk).T.dot(block[chunk])
+    return product.tocsr()
 
-    return sorted(list(cluster_set))
+def _inflation_weights(weights, power):
+    """
+    Row scaling applied to weighted nodes on inflation.
+    """
+    return np.power(np.asarray(weights, dtype=float), 1 - power)
+
+def low_memory_cluster(M, exp_power=2, inf_power=2, iter_count=10,
+                       pr_threshold=0.0001, weights=None, tol=1e-05):
+    """
+    Performs Markov Clustering Algorithm on a dense matrix in float32,
+    reusing two preallocated buffers: each iteration writes the expansion
+    product into the spare buffer and inflates, normalizes and prunes it in
+    place. Converges once no entry changes by more than `tol`.
+    Returns a float32 array.
+    """
+    M = np.array(M, dtype=np.float32)
+    if weights is not None:
+        M *= np.asarray(weights, dtype=np.float32)[:, np.newaxis]
+        inflation_weights = _inflation_weights(weights, inf_power).astype(
+            np.float32)[:, np.newaxis]
+    sums = np.empty(M.shape[1], dtype=np.float32)
+    _normalize_inplace(M, sums)
+    product = np.empty_like(M)
+    converged = False
+    with metrics.timer("mcl.cluster"):
+        for i in range(iter_count):
+            if exp_power == 1:
+                np.copyto(product, M)
+            else:
+                np.dot(M, M, out=product)
+            for j in range(exp_power - 2):
+                product[:] = np.dot(product, M)
+            np.power(product, inf_power, out=product)
+            if weights is not None:
+                product *= inflation_weights
+            _normalize_inplace(product, sums)
+            if pr_threshold > 0:
+                product[product < pr_threshold] = 0
+            if metrics.enabled:
+                metrics.gauge("mcl.nnz", np.count_nonzero(product))
+
+            # The previous matrix is not needed anymore, so the change is
+            # computed in its buffer.
+            np.subtract(M, product, out=M)
+            np.abs(M, out=M)
+            change = M.max() if M.size else 0.0
+            M, product = product, M
+            if change <= tol:
+                converged = True
+                break
+
+    metrics.gauge("mcl.iterations", i + 1 if iter_count > 0 else 0)
+    metrics.gauge("mcl.converged", converged)
+    return M
+
+def _normalize_inplace(M, sums):
+    """
+    Normalizes the columns of M in place, using `sums` as a buffer.
+    """
+    M.sum(axis=0, out=sums)
+    sums[sums == 0] = 1
+    M /= sums
 
 def cluster(M, exp_power=2, inf_power=2, iter_count=10,
-            pr_threshold=0.0001):
+            pr_threshold=0.0001, top_k=None, weights=None, low_memory=False):
     """
     Performs Markov Clustering Algorithm.
     Clusters matrix with the following steps:
@@ -67,20 +408,46 @@ def cluster(M, exp_power=2, inf_power=2, iter_count=10,
             2.1. Expand matrix.
             2.2. Inflate matrix and normalize.
             2.3. Prunes matrix.
+    Sparse matrices are clustered with `sparse_cluster`, where `top_k` limits
+    the number of entries kept per column. `weights` are node weights, see
+    `sparse_cluster`. A `ScoreFile` is clustered with `score_file_cluster`.
+    With `low_memory`, dense matrices are clustered in float32 with
+    `low_memory_cluster`.
     """
+    if isinstance(M, ScoreFile):
+        if weights is not None:
+            raise ValueError("weights are not supported for score files")
+        return score_file_cluster(M, exp_power, inf_power, iter_count,
+                                  pr_threshold, top_k)
+    if sparse.issparse(M):
+        return sparse_cluster(M, exp_power, inf_power, iter_count,
+                              pr_threshold, top_k, weights=weights)
+    if low_memory:
+        return low_memory_cluster(M, exp_power, inf_power, iter_count,
+                                  pr_threshold, weights)
+
+    if weights is not None:
+        M = M * np.asarray(weights, dtype=float)[:, np.newaxis]
     M = normalize(M)
-    for i in range(iter_count):
-        #print("Iteration {}".format(i))
+    converged = False
+    with metrics.timer("mcl.cluster"):
+        for i in range(iter_count):
+            #print("Iteration {}".format(i))
 
-        prev_mat = M.copy() # Copies last matrix for convergence check.
-        matrix = expand(M, exp_power)
-        matrix = inflate(M, inf_power)
+            prev_mat = M.copy() # Copies last matrix for convergence check.
+            M = expand(M, exp_power)
+            M = inflate(M, inf_power, weights)
 
-        if pr_threshold > 0:
-            M = prune(M, pr_threshold)
+            if pr_threshold > 0:
+                M = prune(M, pr_threshold)
+            if metrics.enabled:
+                metrics.gauge("mcl.nnz", np.count_nonzero(M))
 
-        if check_convergence(M, prev_mat):
-            #print("Convergence found. Stopping loop...")
-            break
+            if check_convergence(M, prev_mat):
+                #print("Convergence found. Stopping loop...")
+                converged = True
+                break
 
-    return matrix
+    metrics.gauge("mcl.iterations", i + 1 if iter_count > 0 else 0)
+    metrics.gauge("mcl.converged", converged)
+    return M
@@ -0,0 +1,230 @@
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+
+from itertools import chain, islice
+
+import numpy as np
+
+from instrumentation import metrics, JSONSink
+from manipulate_tweets import ManipulateTweet
+from sliding_window import SlidingWindow, parse_created_at
+
+"""
+Replays stream capture files into the topic detection pipeline.
+A source thread emits the captured tweets at a fixed rate, or at a multiple
+of the pace given by their `created_at`, into a bounded queue. The consumer
+takes them off the queue in batches and clusters them, e.g. with a
+`SlidingWindow`. Each tweet's latency is measured from its scheduled arrival
+to the end of the batch that assigned it to a cluster, along with the queue
+depth and how far the source fell behind its schedule.
+"""
+
+_STOP = object()
+
+
+def schedule(records, rate=None, speed=None):
+    """
+    Returns an iterator of (offset, record) pairs, where offset is the
+    number of seconds after the start of the replay at which the tweet
+    arrives.
+    `rate` - tweets per second.
+    `speed` - multiple of the original pace given by `created_at`; tweets
+    out of order arrive right after the previous one.
+    Without either, every tweet arrives at once.
+    """
+    if rate is not None and speed is not None:
+        raise ValueError("give either a rate or a speed, not both")
+    if (rate is not None and rate <= 0) or (speed is not None and speed <= 0):
+        raise ValueError("rate and speed must be positive")
+    return _offsets(records, rate, speed)
+
+
+def _offsets(records, rate, speed):
+    start = None
+    offset = 0.0
+    for i, record in enumerate(records):
+        if rate is not None:
+            offset = i / rate
+        elif speed is not None:
+            created_at = parse_created_at(record["created_at"])
+            if start is None:
+                start = created_at
+            offset = max(offset,
+                         (created_at - start).total_seconds() / speed)
+        yield offset, record
+
+
+class ReplaySource(threading.Thread):
+    """
+    Source thread putting scheduled tweets on a bounded queue as
+    (arrival time, record) pairs.
+    """
+    def __init__(self, scheduled, max_queue=10000, drop=False):
+        """
+        ReplaySource class constructor.
+        `scheduled` - (offset, record) pairs from `schedule`.
+        `max_queue` - maximum number of tweets waiting to be clustered.
+        `drop` - drops and counts tweets arriving while the queue is full,
+        like `TweetWriter`, instead of waiting for room.
+        """
+        super().__init__(daemon=True)
+        self.scheduled = scheduled
+        self.drop = drop
+        self.emitted = 0
+        self.dropped = 0
+        self.blocked = 0.0
+        self.max_lag = 0.0
+        self.queue = queue.Queue(max_queue)
+        self.start_time = None
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        try:
+            for offset, record in self.scheduled:
+                arrival = self.start_time + offset
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                self.max_lag = max(self.max_lag, time.perf_counter() - arrival)
+                self._put((arrival, record))
+        finally:
+            self.queue.put(_STOP)
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+            self.emitted += 1
+        except queue.Full:
+            if self.drop:
+                self.dropped += 1
+                return
+            start = time.perf_counter()
+            self.queue.put(item)
+            self.blocked += time.perf_counter() - start
+            self.emitted += 1
+
+
+def replay(records, process, rate=None, speed=None, batch_size=500,
+           batch_interval=1.0, max_queue=10000, drop=False):
+    """
+    Replays tweet records into `process`, a function taking a list of
+    records and returning their clusters, e.g. `SlidingWindow.update`.
+    Batches are handed to `process` once `batch_size` tweets are queued or
+    `batch_interval` seconds have passed since the first tweet of the batch
+    arrived. Returns a dict of latency and backpressure statistics.
+    See `schedule` and `ReplaySource` for the other parameters.
+    """
+    source = ReplaySource(schedule(records, rate, speed), max_queue, drop)
+    source.start()
+
+    latencies, batch_seconds, depths = [], [], []
+    clusters = []
+    done = False
+    while not done:
+        item = source.queue.get()
+        if item is _STOP:
+            break
+        batch = [item]
+        deadline = item[0] + batch_interval
+        while len(batch) < batch_size:
+            try:
+                item = source.queue.get(
+                    timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                done = True
+                break
+            batch.append(item)
+
+        start = time.perf_counter()
+        with metrics.timer("replay.batch"):
+            clusters = process([record for _, record in batch])
+        end = time.perf_counter()
+        depths.append(source.queue.qsize())
+        batch_seconds.append(end - start)
+        latencies.extend(end - arrival for arrival, _ in batch)
+        metrics.count("replay.tweets", len(batch))
+    source.join()
+
+    seconds = time.perf_counter() - source.start_time
+    latencies = np.array(latencies)
+    stats = {
+        "tweets": len(latencies),
+        "dropped": source.dropped,
+        "batches": len(batch_seconds),
+        "clusters": len(clusters),
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds if seconds > 0 else 0.0,
+        "latency": _percentiles(latencies),
+        "batch_seconds": _percentiles(np.array(batch_seconds)),
+        "queue_depth": {
+            "mean": float(np.mean(depths)) if depths else 0.0,
+            "max": int(max(depths)) if depths else 0,
+        },
+        "source_blocked_seconds": source.blocked,
+        "source_max_lag": source.max_lag,
+    }
+    metrics.count("replay.dropped", source.dropped)
+    metrics.gauge("replay.latency_p95", stats["latency"]["p95"])
+    metrics.gauge("replay.queue_depth_max", stats["queue_depth"]["max"])
+    metrics.gauge("replay.source_max_lag", source.max_lag)
+    return stats
+
+
+def _percentiles(values):
+    if values.size == 0:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99),
+            "max": float(values.max())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Replays capture files through a sliding window and "
+                    "reports latency and backpressure.")
+    parser.add_argument("paths", nargs="+",
+                        help="capture files, e.g. data/tweets_data*.txt, "
+                             "replayed in the given order")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument("--rate", type=float, default=None,
+                      help="tweets per second")
+    pace.add_argument("--speed", type=float, default=None,
+                      help="multiple of the captured pace")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="replay at most this many tweets")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--batch-interval", type=float, default=1.0)
+    parser.add_argument("--max-queue", type=int, default=10000)
+    parser.add_argument("--drop", action="store_true",
+                        help="drop tweets while the queue is full instead "
+                             "of slowing the source down")
+    parser.add_argument("--window", type=int, default=3600,
+                        help="sliding window length in seconds")
+    parser.add_argument("--iter-count", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--metrics", default=None,
+                        help="also write the pipeline metrics to this "
+                             "JSON file")
+    args = parser.parse_args()
+
+    if args.metrics:
+        metrics.enable(JSONSink(args.metrics))
+
+    manip_tweet = ManipulateTweet()
+    records = islice(chain.from_iterable(
+        manip_tweet.iter_tweets_data(path) for path in args.paths), args.limit)
+    window = SlidingWindow(manip_tweet, args.window, batch_size=1000,
+                           iter_count=args.iter_count, top_k=args.top_k)
+    print("[INFO] Replaying {}".format(", ".join(args.paths)),
+          file=sys.stderr)
+    stats = replay(records, window.update, args.rate, args.speed,
+                   args.batch_size, args.batch_interval, args.max_queue,
+                   args.drop)
+    metrics.report()
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,147 @@
+import os
+import json
+
+import numpy as np
+
+from scipy import sparse
+
+"""
+Out-of-core storage for document score matrices.
+Scores are written in row blocks to memory-mapped files, either as a dense
+float32 matrix or as a thresholded float32 CSR matrix, and read back a few
+rows at a time, so neither writing nor clustering needs the whole matrix in
+memory.
+"""
+
+SCORE_FILE_VERSION = 1
+
+
+class ScoreFileWriter:
+    """
+    Writes a square score matrix to the `path` directory, one block of rows
+    at a time.
+    """
+    def __init__(self, path, size, dense=False):
+        """
+        ScoreFileWriter class constructor.
+        `size` - number of documents.
+        `dense` - writes every score to a dense float32 file instead of
+        the stored entries of the blocks in CSR format.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.size = size
+        self.dense = dense
+        self._row = 0
+        self._sums = np.zeros(size)
+        if dense:
+            self._scores = np.memmap(os.path.join(path, "scores.dat"),
+                                     dtype=np.float32, mode="w+",
+                                     shape=(size, size))
+        else:
+            self._indptr = [np.zeros(1, dtype=np.int64)]
+            self._nnz = 0
+            self._indices = open(os.path.join(path, "indices.dat"), "wb")
+            self._data = open(os.path.join(path, "data.dat"), "wb")
+
+    def write(self, block):
+        """
+        Appends a sparse block of rows.
+        """
+        block = sparse.csr_matrix(block, dtype=np.float32)
+        end = self._row + block.shape[0]
+        self._sums[self._row:end] = np.asarray(block.sum(axis=1)).ravel()
+        if self.dense:
+            self._scores[self._row:end] = block.toarray()
+        else:
+            block.sort_indices()
+            self._indices.write(block.indices.astype(np.int32).tobytes())
+            self._data.write(block.data.tobytes())
+            self._indptr.append(self._nnz + block.indptr[1:].astype(np.int64))
+            self._nnz += block.nnz
+        self._row = end
+
+    def close(self):
+        """
+        Flushes the files and writes the row sums and the metadata.
+        """
+        if self._row != self.size:
+            raise ValueError("{} of {} rows were written".format(
+                self._row, self.size))
+        if self.dense:
+            self._scores.flush()
+            del self._scores
+        else:
+            self._indices.close()
+            self._data.close()
+            np.save(os.path.join(self.path, "indptr.npy"),
+                    np.concatenate(self._indptr))
+        np.save(os.path.join(self.path, "sums.npy"), self._sums)
+        meta = {"version": SCORE_FILE_VERSION, "size": self.size,
+                "format": "dense" if self.dense else "sparse"}
+        if not self.dense:
+            meta["nnz"] = self._nnz
+        with open(os.path.join(self.path, "meta.json"), "w") as output:
+            json.dump(meta, output)
+        return ScoreFile(self.path)
+
+
+class ScoreFile:
+    """
+    Memory-mapped score matrix written by `ScoreFileWriter`. Rows are read
+    on demand as scipy.sparse CSR matrices.
+    """
+    def __init__(self, path):
+        """
+        ScoreFile class constructor. `path` - directory of the score file.
+        """
+        with open(os.path.join(path, "meta.json")) as meta:
+            meta = json.load(meta)
+        if meta.get("version") != SCORE_FILE_VERSION:
+            raise ValueError("Score file at {} has an unsupported "
+                             "version".format(path))
+        self.path = path
+        self.dense = meta["format"] == "dense"
+        self.shape = (meta["size"], meta["size"])
+        self.sums = np.load(os.path.join(path, "sums.npy"))
+        if self.dense:
+            self._scores = np.memmap(os.path.join(path, "scores.dat"),
+                                     dtype=np.float32, mode="r",
+                                     shape=self.shape)
+        else:
+            self._indptr = np.load(os.path.join(path, "indptr.npy"))
+            self._indices = _memmap(os.path.join(path, "indices.dat"),
+                                    np.int32, meta["nnz"])
+            self._data = _memmap(os.path.join(path, "data.dat"),
+                                 np.float32, meta["nnz"])
+
+    def rows(self, indices):
+        """
+        Returns the given rows as a float64 CSR matrix.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.dense:
+            return sparse.csr_matrix(self._scores[indices], dtype=float)
+
+        starts = self._indptr[indices]
+        lengths = self._indptr[indices + 1] - starts
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        positions = np.arange(indptr[-1]) + np.repeat(starts - indptr[:-1],
+                                                      lengths)
+        return sparse.csr_matrix(
+            (self._data[positions].astype(float), self._indices[positions],
+             indptr), shape=(indices.size, self.shape[1]))
+
+    def toarray(self):
+        """
+        Loads the whole matrix as a dense array, e.g. for small windows.
+        """
+        return self.rows(np.arange(self.shape[0])).toarray()
+
+
+def _memmap(path, dtype, count):
+    # np.memmap cannot map empty files.
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
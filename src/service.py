@@ -0,0 +1,316 @@
+import json
+import math
+import time
+import argparse
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Pool
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+
+from nltk.corpus import wordnet as wn
+from scipy import sparse
+
+import mcl
+
+from calculate_similarity import Similarity
+from deduplicate import deduplicate, weights, expand_clusters
+from manipulate_tweets import ManipulateTweet
+from synset_cache import SynsetCache
+from vocabulary import smooth_idf, tfidf
+from wordnet_index import WordNetIndex
+
+"""
+Long-running topic detection service.
+Worker processes keep spaCy, WordNet and the feature similarity scores of
+every term seen so far loaded, and cluster batches of tweets posted to a
+threaded HTTP server, listening on a TCP port or a Unix socket:
+
+    POST /clusters  {"tweets": [{"id_str": ..., "text": ...}, ...],
+                     "options": {"iter_count": 50, "top_k": 20}}
+    GET  /health
+"""
+
+MCL_OPTIONS = ("exp_power", "inf_power", "iter_count", "pr_threshold",
+               "top_k")
+# Checks of the MCL option values, with the error shown when they fail.
+_OPTION_CHECKS = {
+    "exp_power": (lambda v: _is_int(v) and v > 0, "a positive integer"),
+    "iter_count": (lambda v: _is_int(v) and v > 0, "a positive integer"),
+    "top_k": (lambda v: v is None or (_is_int(v) and v > 0),
+              "a positive integer or null"),
+    "inf_power": (lambda v: _is_number(v) and v > 0, "a positive number"),
+    "pr_threshold": (lambda v: _is_number(v) and v >= 0,
+                     "a non-negative number"),
+}
+DEDUP_OPTIONS = (None, "exact", "near")
+
+
+class TopicDetector:
+    """
+    Clusters batches of tweet texts, keeping its models and feature scores
+    between batches. Not thread-safe; the service runs one per worker.
+    """
+    def __init__(self, cache=None, index=None, max_features=100000):
+        """
+        TopicDetector class constructor.
+        `cache` - optional `SynsetCache` shared across runs.
+        `index` - optional `WordNetIndex`.
+        `max_features` - the feature similarity matrix is dropped and built
+        again from the next batch once it holds this many terms.
+        """
+        self.manip_tweet = ManipulateTweet()
+        self.cache = cache
+        self.index = index
+        self.max_features = max_features
+        self._reset()
+        wn.synsets("warm")  # Loads WordNet now instead of on the first batch.
+
+    def detect(self, texts, dedup=None, **mcl_options):
+        """
+        Cleans, tokenizes and clusters tweet texts. Returns clusters as
+        sorted lists of indices into `texts`; tweets without tokens are left
+        out. `dedup` collapses "exact" or "near" duplicates first.
+        """
+        cleaned = list(self.manip_tweet.clean_tweets(texts))
+        members = None
+        if dedup is not None:
+            cleaned, members = deduplicate(cleaned, near=dedup == "near")
+        tokens = self.manip_tweet.tokenize_tweets(cleaned, batch_size=1000)
+        if len(tokens) == 0:
+            return []
+
+        X = self._tfidf(tokens)
+        score_matrix = self.similarity.similarity(X, X, sparse_output=True)
+        node_weights = None if members is None else \
+            weights(members, tokens.doc_ids)
+        matrix = mcl.cluster(score_matrix, weights=node_weights, **mcl_options)
+        clusters = mcl.get_clusters(matrix)
+
+        if members is None:
+            doc_ids = tokens.doc_ids.tolist()
+            return [[doc_ids[i] for i in cluster] for cluster in clusters]
+        return [list(cluster)
+                for cluster in expand_clusters(clusters, members,
+                                               tokens.doc_ids)]
+
+    def _reset(self):
+        self.similarity = Similarity(cache=self.cache, index=self.index)
+        self._feature_ids = {}
+
+    def _tfidf(self, tokens):
+        """
+        TF-IDF matrix of a batch over the features seen so far, using the
+        batch IDF with the smoothing and l2 normalization of
+        `TfidfVectorizer`. Adds the batch's new terms to the features.
+        """
+        new_terms = [term for term in tokens.vocabulary
+                     if term not in self._feature_ids]
+        if len(self._feature_ids) + len(new_terms) > self.max_features:
+            self._reset()
+            new_terms = list(tokens.vocabulary)
+        for term in new_terms:
+            self._feature_ids[term] = len(self._feature_ids)
+        if new_terms:
+            self.similarity.add_features(new_terms)
+
+        counts = tokens.counts()
+        columns = np.array([self._feature_ids[term]
+                            for term in tokens.vocabulary], dtype=np.int64)
+        counts = sparse.csr_matrix(
+            (counts.data, columns[counts.indices], counts.indptr),
+            shape=(counts.shape[0], len(self._feature_ids)))
+
+        df = np.bincount(counts.indices, minlength=counts.shape[1])
+        return tfidf(counts, smooth_idf(counts.shape[0], df))
+
+
+_worker_detector = None
+
+
+def _init_worker(cache_path, index_path, max_features):
+    """
+    Creates the warm `TopicDetector` of a worker process.
+    """
+    global _worker_detector
+    cache = SynsetCache(cache_path) if cache_path else None
+    index = WordNetIndex(index_path) if index_path else None
+    _worker_detector = TopicDetector(cache, index, max_features)
+
+
+def _detect(args):
+    """
+    Worker function of `TopicService.detect`.
+    """
+    texts, options = args
+    return _worker_detector.detect(texts, **options)
+
+
+class TopicService:
+    """
+    Pool of `TopicDetector` worker processes shared by the request threads.
+    """
+    def __init__(self, workers=1, cache_path=None, index_path=None,
+                 max_features=100000):
+        """
+        TopicService class constructor. Starts `workers` processes, each
+        loading its models once. `cache_path` and `index_path` are the
+        optional `SynsetCache` file and `WordNetIndex` directory.
+        """
+        self.workers = workers
+        self.pool = Pool(workers, initializer=_init_worker,
+                         initargs=(cache_path, index_path, max_features))
+
+    def detect(self, tweets, options=None):
+        """
+        Clusters a batch of tweets, given as texts or as dicts with `text`
+        and optionally `id_str`. Returns clusters as lists of tweet ids, or
+        of indices into `tweets` for tweets without one.
+        Raises ValueError on malformed input.
+        """
+        return self.cluster(*self.parse(tweets, options))
+
+    def parse(self, tweets, options=None):
+        """
+        Validates a batch for `cluster`. Returns the tweet texts, their ids
+        and the options. Raises ValueError on malformed input.
+        """
+        if not isinstance(tweets, list):
+            raise ValueError("tweets must be a list")
+        texts, ids = [], []
+        for i, tweet in enumerate(tweets):
+            if isinstance(tweet, str):
+                texts.append(tweet)
+                ids.append(i)
+            elif isinstance(tweet, dict) and isinstance(tweet.get("text"), str):
+                texts.append(tweet["text"])
+                ids.append(tweet.get("id_str", i))
+            else:
+                raise ValueError("tweet {} has no text".format(i))
+
+        if options is not None and not isinstance(options, dict):
+            raise ValueError("options must be an object")
+        options = dict(options or {})
+        unknown = set(options).difference(MCL_OPTIONS + ("dedup",))
+        if unknown:
+            raise ValueError("unknown options: {}".format(
+                ", ".join(sorted(unknown))))
+        if options.get("dedup") not in DEDUP_OPTIONS:
+            raise ValueError("dedup must be 'exact' or 'near'")
+        for name in MCL_OPTIONS:
+            check, expected = _OPTION_CHECKS[name]
+            if name in options and not check(options[name]):
+                raise ValueError("{} must be {}".format(name, expected))
+        return texts, ids, options
+
+    def cluster(self, texts, ids, options):
+        """
+        Clusters a batch validated by `parse` in a worker process.
+        """
+        clusters = self.pool.apply(_detect, ((texts, options),))
+        return [[ids[i] for i in cluster] for cluster in clusters]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) \
+        and math.isfinite(value)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of the service.
+    """
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send(404, {"error": "not found"})
+        self._send(200, {"status": "ok", "workers": self.server.service.workers})
+
+    def do_POST(self):
+        if self.path != "/clusters":
+            return self._send(404, {"error": "not found"})
+        start = time.perf_counter()
+        service = self.server.service
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+            batch = service.parse(body["tweets"], body.get("options"))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self._send(400, {"error": "invalid request: {}".format(e)})
+        # Errors raised while clustering are the service's, not the client's.
+        try:
+            clusters = service.cluster(*batch)
+        except Exception as e:
+            print("[ERROR] /clusters: {!r}".format(e))
+            return self._send(500, {"error": "internal error: {!r}".format(e)})
+        self._send(200, {"clusters": clusters,
+                         "seconds": time.perf_counter() - start})
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else "unix"
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host="127.0.0.1", port=8000, unix_socket=None):
+    """
+    Serves requests until interrupted, then stops the workers.
+    """
+    if unix_socket:
+        server = ThreadingUnixHTTPServer(unix_socket, RequestHandler)
+        address = unix_socket
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        address = "http://{}:{}".format(host, port)
+    server.service = service
+    print("[INFO] Serving on {}".format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Serves topic detection over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", default=None,
+                        help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--cache", default=None,
+                        help="SynsetCache file shared by the workers")
+    parser.add_argument("--index", default=None,
+                        help="WordNetIndex directory")
+    parser.add_argument("--max-features", type=int, default=100000)
+    args = parser.parse_args()
+
+    serve(TopicService(args.workers, args.cache, args.index,
+                       args.max_features),
+          args.host, args.port, args.unix_socket)
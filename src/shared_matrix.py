@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+
+from scipy import sparse
+
+"""
+Sparse matrices shared between processes through .npy files.
+A matrix is saved once to a directory and memory-mapped by every process
+that loads it, so worker pools do not get a pickled copy each.
+"""
+
+_FORMATS = {"csr": sparse.csr_matrix, "csc": sparse.csc_matrix}
+
+
+def save_shared(directory, name, M):
+    """
+    Saves the arrays of a CSR or CSC matrix to `directory` under `name`.
+    Other sparse formats are saved as CSR. Indices are sorted first, since
+    loaded matrices are read-only and cannot be sorted in place.
+    """
+    if M.format not in _FORMATS:
+        M = sparse.csr_matrix(M)
+    if not M.has_canonical_format:
+        M = M.copy()
+        M.sum_duplicates()
+    for attr in ("data", "indices", "indptr"):
+        np.save(os.path.join(directory, "{}_{}.npy".format(name, attr)),
+                getattr(M, attr))
+    np.save(os.path.join(directory, "{}_shape.npy".format(name)),
+            np.array(M.shape))
+    np.save(os.path.join(directory, "{}_format.npy".format(name)),
+            np.array(M.format))
+
+
+def load_shared(directory, name):
+    """
+    Loads a matrix saved by `save_shared`, in its saved format, without
+    copying its arrays.
+    """
+    arrays = [np.load(os.path.join(directory, "{}_{}.npy".format(name, attr)),
+                      mmap_mode="r")
+              for attr in ("data", "indices", "indptr")]
+    shape = tuple(np.load(os.path.join(directory, "{}_shape.npy".format(name))))
+    matrix_format = str(np.load(
+        os.path.join(directory, "{}_format.npy".format(name))))
+    return _FORMATS[matrix_format](tuple(arrays), shape=shape, copy=False)
@@ -0,0 +1,223 @@
+import numpy as np
+
+from collections import deque
+from datetime import datetime
+from scipy import sparse
+
+import mcl
+
+from calculate_similarity import Similarity
+from vocabulary import smooth_idf, tfidf
+
+"""
+Incremental topic detection over a sliding time window of tweets.
+Only arriving tweets are vectorized and scored; expiring tweets are sliced
+out of the score matrix, and MCL is warm-started from the previous window.
+"""
+
+CREATED_AT_FORMAT = "%a %b %d %H:%M:%S %z %Y"
+
+
+class SlidingWindow:
+    """
+    Sliding window of tweets keeping TF-IDF statistics, soft cosine scores
+    and the last MCL result up to date as tweets arrive and expire.
+    """
+    def __init__(self, manip_tweet, window=3600, cache=None,
+                 refresh_ratio=0.5, batch_size=1000, **mcl_options):
+        """
+        SlidingWindow class constructor.
+        `manip_tweet` - class object instance of manipulate tweet module.
+        `window` - window length in seconds.
+        `cache` - optional `SynsetCache` shared across runs.
+        `refresh_ratio` - scores of documents that stayed in the window use
+        the IDF of the batch they were scored in; every score is recomputed,
+        and terms of expired tweets are dropped, once this fraction of the
+        window has changed.
+        `mcl_options` - options passed to `mcl.sparse_cluster`.
+        """
+        self.manip_tweet = manip_tweet
+        self.window = window
+        self.refresh_ratio = refresh_ratio
+        self.batch_size = batch_size
+        self.mcl_options = mcl_options
+        self.similarity = Similarity(cache=cache)
+
+        self._vocabulary = {}
+        self._ids = deque()
+        self._times = deque()
+        self._tf = sparse.csr_matrix((0, 0))
+        self._df = np.zeros(0)
+        self._scores = sparse.csr_matrix((0, 0))
+        self._flow = None
+        self._changed = 0
+        self.dropped = 0
+
+    def update(self, records, now=None):
+        """
+        Adds new tweet records (dicts with `id_str`, `created_at` and `text`),
+        expires tweets older than the window and returns the clusters of the
+        window as lists of tweet ids. `now` is a timezone-aware datetime and
+        defaults to the latest `created_at` seen.
+        Tweets are expired from the front of the window, so the window
+        assumes they arrive in `created_at` order. Records already older
+        than the window are dropped and counted in `dropped`; other late
+        tweets are added at the end and expire once the tweets before them
+        have.
+        """
+        records = list(records)
+        times = [parse_created_at(r["created_at"]) for r in records]
+        if now is None:
+            latest = times + list(self._times)[-1:]
+            now = max(latest) if latest else None
+        if now is not None:
+            self._expire(now)
+            kept = [i for i, created_at in enumerate(times)
+                    if (now - created_at).total_seconds() <= self.window]
+            self.dropped += len(records) - len(kept)
+            records = [records[i] for i in kept]
+            times = [times[i] for i in kept]
+
+        cleaned = list(self.manip_tweet.clean_tweets(r["text"] for r in records))
+        tokens = self.manip_tweet.tokenize_tweets(cleaned,
+                                                  batch_size=self.batch_size)
+
+        ids, doc_times, counts = [], [], []
+        new_terms = []
+        for doc_id, tokenized in zip(tokens.doc_ids, tokens):
+            doc_counts = {}
+            for term in tokenized:
+                if term not in self._vocabulary:
+                    self._vocabulary[term] = len(self._vocabulary)
+                    new_terms.append(term)
+                index = self._vocabulary[term]
+                doc_counts[index] = doc_counts.get(index, 0) + 1
+            ids.append(records[doc_id]["id_str"])
+            doc_times.append(times[doc_id])
+            counts.append(doc_counts)
+
+        if new_terms:
+            self.similarity.add_features(new_terms)
+            self._tf = _resize(self._tf, self._tf.shape[0],
+                               len(self._vocabulary))
+            self._df = np.concatenate([self._df, np.zeros(len(new_terms))])
+
+        self._append(ids, doc_times, counts)
+        return self.clusters()
+
+    def clusters(self):
+        """
+        Clusters the current window, warm-starting MCL from the previous
+        result. Returns clusters as lists of tweet ids.
+        """
+        size = len(self._ids)
+        if size == 0:
+            return []
+
+        init = None
+        if self._flow is not None and self._flow.shape[0] > 0:
+            init = _resize(self._flow, size, size)
+        self._flow = mcl.sparse_cluster(self._scores, init=init,
+                                        **self.mcl_options)
+
+        ids = list(self._ids)
+        return [[ids[i] for i in cluster]
+                for cluster in mcl.get_clusters(self._flow)]
+
+    def _expire(self, now):
+        """
+        Removes tweets older than the window from the front of the window.
+        """
+        expired = 0
+        while expired < len(self._times) and \
+                (now - self._times[expired]).total_seconds() > self.window:
+            expired += 1
+        if expired == 0:
+            return
+
+        self._df -= np.asarray((self._tf[:expired] > 0).sum(axis=0)).ravel()
+        self._tf = self._tf[expired:]
+        self._scores = self._scores[expired:, expired:]
+        if self._flow is not None:
+            self._flow = self._flow[expired:, expired:]
+        for i in range(expired):
+            self._ids.popleft()
+            self._times.popleft()
+        self._changed += expired
+
+    def _append(self, ids, times, counts):
+        """
+        Adds tweets to the end of the window and scores them against every
+        tweet in the window. Rescores the whole window once enough of it has
+        changed since the last full refresh.
+        """
+        if not ids:
+            return
+        rows = np.repeat(np.arange(len(counts)), [len(c) for c in counts])
+        cols = [index for c in counts for index in c]
+        data = [count for c in counts for count in c.values()]
+        new_tf = sparse.csr_matrix((data, (rows, cols)),
+                                   shape=(len(counts), len(self._vocabulary)))
+
+        self._df += np.asarray((new_tf > 0).sum(axis=0)).ravel()
+        self._tf = sparse.vstack([self._tf, new_tf], format="csr")
+        self._ids.extend(ids)
+        self._times.extend(times)
+        self._changed += len(ids)
+
+        size = len(self._ids)
+        old = size - len(ids)
+        if old == 0 or self._changed > self.refresh_ratio * size:
+            self._remove_unused_terms()
+            X = self._tfidf()
+            self._scores = self.similarity.similarity(X, X, sparse_output=True)
+            self._changed = 0
+            return
+
+        X = self._tfidf()
+        S = self.similarity.feature_similarity()
+        XS = X.dot(S)
+        denom = np.sqrt(np.asarray(XS.multiply(X).sum(axis=1)).ravel())
+        block = sparse.diags(1 / denom[old:]).dot(XS[old:].dot(X.T)).dot(
+            sparse.diags(1 / denom))
+        block = block.tocsr()
+        new_new = self.similarity._mirror_sparse(block[:, old:].tocoo())
+        self._scores = sparse.bmat([[self._scores, block[:, :old].T],
+                                    [block[:, :old], new_new]], format="csr")
+
+    def _remove_unused_terms(self):
+        """
+        Drops the terms no tweet in the window uses anymore from the
+        vocabulary, the term counts and the feature similarity matrix, so
+        they stay bounded by the window instead of the whole stream.
+        """
+        keep = np.nonzero(self._df > 0)[0]
+        if len(keep) == len(self._df):
+            return
+        terms = sorted(self._vocabulary, key=self._vocabulary.__getitem__)
+        self._vocabulary = {terms[j]: i for i, j in enumerate(keep)}
+        self._tf = self._tf[:, keep]
+        self._df = self._df[keep]
+        self.similarity.remove_features(keep)
+
+    def _tfidf(self):
+        """
+        TF-IDF matrix of the window, using the same smoothed IDF and l2
+        normalization as `TfidfVectorizer`.
+        """
+        return tfidf(self._tf, smooth_idf(len(self._ids), self._df))
+
+
+def parse_created_at(created_at):
+    """
+    Parses the `created_at` field of a tweet.
+    """
+    return datetime.strptime(created_at, CREATED_AT_FORMAT)
+
+
+def _resize(M, n_rows, n_cols):
+    """
+    Returns a CSR copy of sparse matrix M, padded with empty rows and columns.
+    """
+    M = M.tocoo()
+    return sparse.csr_matrix((M.data, (M.row, M.col)), shape=(n_rows, n_cols))
@@ -9,6 +9,8 @@ from http.client import IncompleteRead
 from time import clock
 from urllib3.exceptions import ProtocolError
 
+from tweet_writer import TweetWriter
+
 with open('.access_tokens.json') as data_file:
     data = json.load(data_file)
 
@@ -20,21 +22,22 @@ consumer_secret = data["consumer_secret"]
 
 class TweetStreamListener(StreamListener):
     """ A listener handles tweets that are received from the stream.
-        Writes retrieved tweets to file.
+        Hands retrieved tweets to a background writer.
     """
 
+    def __init__(self, writer, api=None):
+        super().__init__(api)
+        self.writer = writer
+
     def on_status(self, status):
         """
-        Retrieves tweet data and writes it to file.
+        Retrieves tweet data and queues it for writing to file.
         """
         try:
-            # Save streamed tweets to "data" folder
-            with open('data/tweets_data.txt', 'a') as td:
-                # If tweet language is English, save
-                if (status.lang is not None and status.lang == 'en'):
-                    td.write(json.dumps(status._json))
-                    td.write('\n')
-                return True
+            # If tweet language is English, save
+            if (status.lang is not None and status.lang == 'en'):
+                self.writer.put(json.dumps(status._json))
+            return True
 
         except BaseException as e:
             print("[ERROR] on_status: {}".format(e))
@@ -55,8 +58,12 @@ if __name__ == '__main__':
 
     print("Time started: {}".format(datetime.now()))
 
+    # Save streamed tweets to "data" folder
+    writer = TweetWriter('data/tweets_data.txt')
+    writer.start()
+
     #This handles Twitter authetification and the connection to Twitter Streaming API
-    tsl = TweetStreamListener()
+    tsl = TweetStreamListener(writer)
     auth = OAuthHandler(consumer_key, consumer_secret)
     auth.set_access_token(access_token, access_token_secret)
     # stream = Stream(auth, tsl)
@@ -80,4 +87,7 @@ if __name__ == '__main__':
             stream.disconnect()
             break
 
+    writer.stop()
+    print("Tweets written: {}, dropped: {}".format(writer.written,
+                                                   writer.dropped))
     print("Time ended: {}".format(datetime.now()))
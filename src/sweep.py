@@ -0,0 +1,203 @@
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import itertools
+
+import numpy as np
+
+from multiprocessing import Pool
+from scipy import sparse
+
+import mcl
+
+from calculate_similarity import Similarity
+from shared_matrix import save_shared, load_shared
+from manipulate_tweets import ManipulateTweet
+from synset_cache import SynsetCache
+
+"""
+MCL parameter sweep over one score matrix.
+The score matrix is computed and normalized once and saved to a temporary
+directory, which the pool of worker processes memory-maps. The first
+expansion is computed once per (exp_power, pr_threshold, top_k) and saved
+there too. Every setting then continues from its memory-mapped expansion,
+and is reported with its cluster count, cluster size distribution,
+modularity and runtime.
+"""
+
+DEFAULT_GRID = {
+    "exp_power": [2],
+    "inf_power": [1.4, 2, 3, 4],
+    "pr_threshold": [0.0001],
+    "top_k": [None],
+    "iter_count": [50],
+}
+_EXPANSION_KEYS = ("exp_power", "pr_threshold", "top_k")
+
+
+def sweep(M, grid=None, workers=1):
+    """
+    Clusters score matrix M with every combination of the MCL parameters
+    in `grid`, a dict of parameter name to list of values; parameters
+    missing from it take their `DEFAULT_GRID` values. Dense matrices are
+    clustered as sparse. Returns one dict per setting, in grid order.
+    """
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    names = sorted(grid)
+    settings = [dict(zip(names, values))
+                for values in itertools.product(*(grid[n] for n in names))]
+    if any(setting["iter_count"] < 1 for setting in settings):
+        raise ValueError("iter_count must be at least 1")
+    keys = sorted(set(_expansion_key(s) for s in settings), key=str)
+
+    directory = tempfile.mkdtemp(prefix="sweep_")
+    pool = None
+    try:
+        M = sparse.csr_matrix(M)
+        save_shared(directory, "scores", M)
+        save_shared(directory, "normalized", mcl.sparse_normalize(M))
+        del M
+        pool = Pool(workers, initializer=_init_worker, initargs=(directory,))
+        names = ["expansion_{}".format(i) for i in range(len(keys))]
+        seconds = pool.map(_expand, [(directory, name, key)
+                                     for name, key in zip(names, keys)])
+        expansions = dict(zip(keys, zip(names, seconds)))
+        results = pool.map(_run_setting, [
+            (setting, directory) + expansions[_expansion_key(setting)]
+            for setting in settings])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def modularity(M, labels):
+    """
+    Newman modularity of a labeling of the weighted graph M. Nodes labeled
+    -1 count as clusters of their own.
+    """
+    M = sparse.coo_matrix(M)
+    labels = np.array(labels)
+    unassigned = labels < 0
+    labels[unassigned] = labels.max() + 1 + np.arange(unassigned.sum())
+    degrees = np.asarray(M.sum(axis=1)).ravel()
+    total = degrees.sum()
+    if total == 0:
+        return 0.0
+    within = M.data[labels[M.row] == labels[M.col]].sum()
+    cluster_degrees = np.bincount(labels, weights=degrees)
+    return float(within / total - np.sum((cluster_degrees / total) ** 2))
+
+
+def _expansion_key(setting):
+    return tuple(setting[name] for name in _EXPANSION_KEYS)
+
+
+_worker_matrix = None
+_worker_normalized = None
+
+
+def _init_worker(directory):
+    """
+    Memory-maps the score matrix and its normalized matrix, saved once to
+    `directory` by `sweep`, in a sweep worker process.
+    """
+    global _worker_matrix, _worker_normalized
+    _worker_matrix = load_shared(directory, "scores")
+    _worker_normalized = load_shared(directory, "normalized")
+
+
+def _expand(args):
+    """
+    Computes the first expansion of the normalized matrix and saves it to
+    `directory`, where the settings continuing from it memory-map it
+    instead of receiving a copy. Returns its runtime.
+    """
+    directory, name, (exp_power, pr_threshold, top_k) = args
+    start = time.perf_counter()
+    expanded = mcl.sparse_expand(_worker_normalized, exp_power, pr_threshold,
+                                 top_k)
+    seconds = time.perf_counter() - start
+    save_shared(directory, name, expanded)
+    return seconds
+
+
+def _run_setting(args):
+    """
+    Finishes MCL from a first expansion and summarizes the clustering.
+    """
+    setting, directory, name, expansion_seconds = args
+    expanded = load_shared(directory, name)
+    start = time.perf_counter()
+    M = mcl.sparse_inflate(expanded, setting["inf_power"])
+    if setting["iter_count"] > 1:
+        M = mcl.sparse_cluster(M, setting["exp_power"], setting["inf_power"],
+                               setting["iter_count"] - 1,
+                               setting["pr_threshold"], setting["top_k"])
+    labels, sizes = mcl.cluster_labels(M)
+    seconds = time.perf_counter() - start
+
+    return {
+        "setting": setting,
+        "clusters": len(sizes),
+        "unassigned": int((labels < 0).sum()),
+        "singletons": int((sizes == 1).sum()),
+        "sizes": {
+            "min": int(sizes.min()) if len(sizes) else 0,
+            "median": float(np.median(sizes)) if len(sizes) else 0.0,
+            "mean": float(sizes.mean()) if len(sizes) else 0.0,
+            "max": int(sizes.max()) if len(sizes) else 0,
+        },
+        "modularity": modularity(_worker_matrix, labels),
+        "seconds": seconds,
+        "expansion_seconds": expansion_seconds,
+    }
+
+
+def _values(text, cast):
+    return [None if value == "none" else cast(value)
+            for value in text.split(",")]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Sweeps MCL parameters over the tweets of a capture "
+                    "file.")
+    parser.add_argument("path", help="capture file to cluster")
+    parser.add_argument("--exp-power", default="2")
+    parser.add_argument("--inf-power", default="1.4,2,3,4")
+    parser.add_argument("--pr-threshold", default="0.0001")
+    parser.add_argument("--top-k", default="none",
+                        help="comma separated values; 'none' keeps all")
+    parser.add_argument("--iter-count", default="50")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--cache", default=None,
+                        help="SynsetCache file to use; no cache by default")
+    args = parser.parse_args()
+
+    manip_tweet = ManipulateTweet()
+    documents = manip_tweet.preprocess_tweet(
+        manip_tweet.iter_tweets_data(args.path))
+    tokens = manip_tweet.tokenize_tweets(documents, batch_size=1000)
+    cache = SynsetCache(args.cache) if args.cache else None
+    start = time.perf_counter()
+    score_matrix = Similarity(tokens, cache=cache).similarity(
+        sparse_output=True)
+    if cache is not None:
+        cache.close()
+    print("[INFO] {} documents scored in {:.2f}s".format(
+        len(tokens), time.perf_counter() - start), file=sys.stderr)
+
+    grid = {
+        "exp_power": _values(args.exp_power, int),
+        "inf_power": _values(args.inf_power, float),
+        "pr_threshold": _values(args.pr_threshold, float),
+        "top_k": _values(args.top_k, int),
+        "iter_count": _values(args.iter_count, int),
+    }
+    print(json.dumps(sweep(score_matrix, grid, args.workers), indent=2))
@@ -0,0 +1,124 @@
+import sqlite3
+
+from nltk.corpus import wordnet as wn
+
+"""
+Persistent WordNet cache shared across runs.
+Stores the best synsets of each compared term pair and their wup_similarity
+score in an SQLite file, so warm runs can skip WordNet graph traversals.
+"""
+
+CACHE_VERSION = 1
+DEFAULT_PATH = "data/synset_cache.db"
+DEFAULT_MAX_ENTRIES = 1000000
+
+
+class SynsetCache:
+    """
+    SQLite-backed term pair -> (best synsets, score) store with a versioned
+    key and LRU eviction. Lookups and new entries are kept in memory and
+    written to disk on `flush`.
+    """
+    def __init__(self, path=DEFAULT_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        SynsetCache class constructor.
+        `path` - SQLite file where the cache is stored.
+        `max_entries` - maximum number of term pairs kept in the file. Least
+        recently used pairs are evicted first.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.key = "{}:{}".format(CACHE_VERSION, wn.get_version())
+        self._conn = sqlite3.connect(path)
+        self._pending = {}
+        self._touched = set()
+        self._setup()
+        self._clock = self._conn.execute(
+            "SELECT COALESCE(MAX(used), 0) FROM pairs").fetchone()[0]
+
+    def get(self, term1, term2):
+        """
+        Gets cached best synsets and score of a term pair. Returns None if the
+        pair has not been cached yet.
+        """
+        key = tuple(sorted((term1, term2)))
+        row = self._pending.get(key)
+        if row is None:
+            row = self._conn.execute(
+                "SELECT synset1, synset2, score FROM pairs "
+                "WHERE term1 = ? AND term2 = ?", key).fetchone()
+            if row is None:
+                return None
+            self._touched.add(key)
+
+        syn1, syn2, score = (self._to_synset(row[0]),
+                             self._to_synset(row[1]), row[2])
+        if key[0] != term1:
+            syn1, syn2 = syn2, syn1
+        return syn1, syn2, score
+
+    def put(self, term1, term2, syn1, syn2, score):
+        """
+        Adds best synsets and score of a term pair to the cache.
+        """
+        if term1 > term2:
+            term1, term2 = term2, term1
+            syn1, syn2 = syn2, syn1
+        self._pending[(term1, term2)] = (self._to_name(syn1),
+                                         self._to_name(syn2), score)
+
+    def flush(self):
+        """
+        Writes new and recently used pairs to disk and evicts the least
+        recently used pairs if the cache exceeds its maximum size.
+        """
+        if not self._pending and not self._touched:
+            return
+        self._clock += 1
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?)",
+            [key + value + (self._clock,)
+             for key, value in self._pending.items()])
+        self._conn.executemany(
+            "UPDATE pairs SET used = ? WHERE term1 = ? AND term2 = ?",
+            [(self._clock,) + key for key in self._touched])
+        self._conn.execute(
+            "DELETE FROM pairs WHERE rowid IN (SELECT rowid FROM pairs "
+            "ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self._conn.commit()
+        self._pending.clear()
+        self._touched.clear()
+
+    def close(self):
+        """
+        Flushes pending entries and closes the cache file.
+        """
+        self.flush()
+        self._conn.close()
+
+    def _setup(self):
+        """
+        Creates cache tables. Drops old entries if they were written with a
+        different cache or WordNet version.
+        """
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                           "(name TEXT PRIMARY KEY, value TEXT)")
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE name = 'key'").fetchone()
+        if row is None or row[0] != self.key:
+            self._conn.execute("DROP TABLE IF EXISTS pairs")
+            self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('key', ?)",
+                               (self.key,))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pairs (term1 TEXT, term2 TEXT, "
+            "synset1 TEXT, synset2 TEXT, score REAL, used INTEGER, "
+            "PRIMARY KEY (term1, term2))")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS pairs_used ON pairs (used)")
+        self._conn.commit()
+
+    def _to_name(self, synset):
+        return synset.name() if synset is not None else None
+
+    def _to_synset(self, name):
+        return wn.synset(name) if name is not None else None
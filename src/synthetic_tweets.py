@@ -0,0 +1,98 @@
+import json
+import random
+
+from datetime import datetime, timedelta, timezone
+
+"""
+Synthetic tweet corpus generator.
+Writes reproducible JSONL capture files in the format of `stream_tweets.py`,
+with topical word pools, slang, hashtags, mentions, links, emojis and
+retweets, so the pipeline can be exercised without network access.
+"""
+
+TOPICS = [
+    ["earthquake", "ground", "shake", "magnitude", "aftershock", "epicenter",
+     "building", "damage", "tremor", "city"],
+    ["game", "team", "score", "player", "goal", "season", "coach", "win",
+     "match", "fans"],
+    ["election", "vote", "president", "campaign", "debate", "senate",
+     "policy", "party", "candidate", "poll"],
+    ["phone", "apple", "release", "screen", "battery", "camera", "update",
+     "price", "store", "launch"],
+    ["movie", "actor", "trailer", "premiere", "film", "director", "cinema",
+     "sequel", "review", "ticket"],
+    ["storm", "rain", "flood", "wind", "weather", "hurricane", "warning",
+     "coast", "power", "shelter"],
+    ["music", "album", "song", "concert", "singer", "tour", "band",
+     "stage", "guitar", "chart"],
+    ["dog", "cat", "puppy", "pet", "animal", "shelter", "adopt", "rescue",
+     "kitten", "vet"],
+]
+FILLER = ["lol", "omg", "wtf", "tbh", "smh", "gonna", "really", "just",
+          "today", "so", "the", "is", "a", "my", "this", "cant", "believe",
+          "why", "yall", "ngl"]
+EMOJIS = ["\U0001F602", "\U0001F525", "\U0001F62D", "\U0001F64F",
+          "\U0001F680", "\u2026"]
+CREATED_AT_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+START_TIME = datetime(2017, 9, 27, 7, 45, tzinfo=timezone.utc)
+START_ID = 913000000000000000
+
+
+def generate_tweets(count, seed=0, rate=50.0, retweet_ratio=0.2):
+    """
+    Generates `count` tweets as dicts. Tweets arrive at `rate` tweets per
+    second on average, and `retweet_ratio` of them are retweets of an
+    earlier tweet.
+    """
+    rng = random.Random(seed)
+    created = START_TIME
+    history = []
+    for i in range(count):
+        created += timedelta(seconds=rng.expovariate(rate))
+        if history and rng.random() < retweet_ratio:
+            user, text = rng.choice(history)
+            text = "RT @{}: {}".format(user, text)[:140]
+        else:
+            text = _random_text(rng)
+            history.append(("user{}".format(rng.randrange(1000)), text))
+            history = history[-1000:]
+
+        tweet_id = START_ID + i
+        yield {
+            "created_at": created.strftime(CREATED_AT_FORMAT),
+            "id": tweet_id,
+            "id_str": str(tweet_id),
+            "text": text,
+            "lang": "en",
+            "timestamp_ms": str(int(created.timestamp() * 1000)),
+            "user": {"screen_name": "user{}".format(rng.randrange(1000))},
+        }
+
+
+def write_corpus(path, count, seed=0, **options):
+    """
+    Writes a synthetic capture file with one JSON tweet per line.
+    """
+    with open(path, "w") as td:
+        for tweet in generate_tweets(count, seed, **options):
+            td.write(json.dumps(tweet))
+            td.write("\n")
+    return path
+
+
+def _random_text(rng):
+    """
+    Builds a tweet text mostly made of words of one topic.
+    """
+    topic = rng.choice(TOPICS)
+    words = [rng.choice(topic) if rng.random() < 0.6 else rng.choice(FILLER)
+             for i in range(rng.randint(4, 14))]
+    if rng.random() < 0.3:
+        words.append("#" + rng.choice(topic))
+    if rng.random() < 0.2:
+        words.insert(0, "@user{}".format(rng.randrange(1000)))
+    if rng.random() < 0.2:
+        words.append(rng.choice(EMOJIS))
+    if rng.random() < 0.3:
+        words.append("https://t.co/{:010x}".format(rng.getrandbits(40)))
+    return " ".join(words)[:140]
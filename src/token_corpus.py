@@ -0,0 +1,162 @@
+import os
+import json
+
+import numpy as np
+
+from array import array
+from scipy import sparse
+
+"""
+Compact array-backed token store.
+A corpus keeps an interned vocabulary and, for every document, its token ids
+as a slice of one flat array (CSR layout), instead of a dict of token lists
+keyed by tweet text. Corpora are saved as .npy files and can be loaded
+memory-mapped.
+"""
+
+CORPUS_VERSION = 1
+
+_ARRAYS = ("vocabulary", "indptr", "token_ids", "doc_ids")
+
+
+class TokenCorpus:
+    """
+    Tokenized documents stored as integer arrays.
+    `vocabulary` - list of terms, a term's id is its position.
+    `indptr` - tokens of document i are `token_ids[indptr[i]:indptr[i + 1]]`.
+    `doc_ids` - integer id of each document, e.g. its position in the
+    tokenizer input.
+    """
+    def __init__(self, vocabulary=None, indptr=None, token_ids=None,
+                 doc_ids=None):
+        """
+        TokenCorpus class constructor. Creates an empty corpus unless the
+        arrays of an existing one are given.
+        """
+        self.vocabulary = list(vocabulary) if vocabulary is not None else []
+        self._term_ids = None
+        if indptr is None:
+            self._indptr = array("q", [0])
+            self._token_ids = array("i")
+            self._doc_ids = array("q")
+        else:
+            self._indptr = indptr
+            self._token_ids = token_ids
+            self._doc_ids = doc_ids
+
+    @classmethod
+    def from_tokens(cls, tokens, doc_ids=None):
+        """
+        Builds a corpus from an iterable of token lists.
+        """
+        corpus = cls()
+        if doc_ids is None:
+            for tokenized in tokens:
+                corpus.append(tokenized)
+        else:
+            for doc_id, tokenized in zip(doc_ids, tokens):
+                corpus.append(tokenized, doc_id)
+        return corpus
+
+    @property
+    def indptr(self):
+        return np.asarray(self._indptr, dtype=np.int64)
+
+    @property
+    def token_ids(self):
+        return np.asarray(self._token_ids, dtype=np.int32)
+
+    @property
+    def doc_ids(self):
+        return np.asarray(self._doc_ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._indptr) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.tokens(i)
+
+    def append(self, tokens, doc_id=None):
+        """
+        Adds a document. Its id defaults to the number of documents already
+        in the corpus.
+        """
+        if not isinstance(self._indptr, array):
+            raise ValueError("Loaded corpora are read-only")
+        term_ids = self._get_term_ids()
+        for term in tokens:
+            term_id = term_ids.get(term)
+            if term_id is None:
+                term_id = term_ids[term] = len(self.vocabulary)
+                self.vocabulary.append(term)
+            self._token_ids.append(term_id)
+        self._indptr.append(len(self._token_ids))
+        self._doc_ids.append(len(self) - 1 if doc_id is None else doc_id)
+
+    def tokens(self, i):
+        """
+        Returns the tokens of the i-th document as a list of terms.
+        """
+        start, end = self._indptr[i], self._indptr[i + 1]
+        return [self.vocabulary[term_id]
+                for term_id in self._token_ids[start:end]]
+
+    def term_id(self, term):
+        """
+        Returns the id of a term, or None if it is not in the vocabulary.
+        """
+        return self._get_term_ids().get(term)
+
+    def counts(self):
+        """
+        Returns the documents x vocabulary term count matrix as a
+        scipy.sparse CSR matrix.
+        """
+        indptr = self.indptr
+        counts = sparse.csr_matrix(
+            (np.ones(indptr[-1]), self.token_ids, indptr),
+            shape=(len(self), len(self.vocabulary)), copy=True)
+        counts.sum_duplicates()
+        return counts
+
+    def save(self, path):
+        """
+        Saves the corpus to the `path` directory.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        arrays = {
+            "vocabulary": np.array([t.encode("utf-8") for t in self.vocabulary]
+                                   or [b""])[:len(self.vocabulary)],
+            "indptr": self.indptr,
+            "token_ids": self.token_ids,
+            "doc_ids": self.doc_ids,
+        }
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), values)
+        with open(os.path.join(path, "meta.json"), "w") as meta:
+            json.dump({"corpus": CORPUS_VERSION}, meta)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Loads a corpus saved by `save`. Arrays are memory-mapped unless
+        `mmap_mode` is None. Loaded corpora are read-only.
+        """
+        with open(os.path.join(path, "meta.json")) as meta:
+            if json.load(meta) != {"corpus": CORPUS_VERSION}:
+                raise ValueError("Token corpus at {} has an unsupported "
+                                 "version".format(path))
+        arrays = {name: np.load(os.path.join(path, name + ".npy"),
+                                mmap_mode=mmap_mode)
+                  for name in _ARRAYS}
+        vocabulary = [term.decode("utf-8") for term in arrays["vocabulary"]]
+        return cls(vocabulary, arrays["indptr"], arrays["token_ids"],
+                   arrays["doc_ids"])
+
+    def _get_term_ids(self):
+        if self._term_ids is None:
+            self._term_ids = {term: i for i, term in enumerate(self.vocabulary)}
+        return self._term_ids
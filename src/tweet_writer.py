@@ -0,0 +1,141 @@
+import os
+import gzip
+import queue
+import shutil
+import threading
+import time
+
+from datetime import datetime
+
+"""
+Buffered background writer for streamed tweets.
+The stream listener hands lines to a bounded queue and returns right away;
+a writer thread appends them to disk in batches.
+"""
+
+_STOP = object()
+
+
+class TweetWriter(threading.Thread):
+    """
+    Writer thread taking tweet lines from a bounded queue and appending them
+    to the capture file in batches. Optionally rotates the file every hour
+    and gzips the rotated files.
+    """
+    def __init__(self, path="data/tweets_data.txt", max_queue=10000,
+                 batch_size=500, flush_interval=1.0, rotate=False,
+                 compress=False):
+        """
+        TweetWriter class constructor.
+        `path` - capture file. With `rotate`, the hour is added to its name,
+        e.g. data/tweets_data_2017092707.txt.
+        `max_queue` - maximum number of lines waiting to be written. Lines
+        put while the queue is full are dropped and counted.
+        `batch_size`, `flush_interval` - lines are written once this many
+        are buffered or this many seconds have passed.
+        `compress` - gzips each file after it is rotated.
+        """
+        super().__init__(daemon=True)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate = rotate
+        self.compress = compress
+        self.written = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._file = None
+        self._file_path = None
+
+    @property
+    def queue_depth(self):
+        """
+        Number of lines waiting to be written.
+        """
+        return self._queue.qsize()
+
+    def put(self, line):
+        """
+        Queues a line without blocking. Returns False if the line was dropped
+        because the queue is full.
+        """
+        try:
+            self._queue.put_nowait(line)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def stop(self):
+        """
+        Writes the remaining lines and stops the writer thread.
+        """
+        self._queue.put(_STOP)
+        self.join()
+
+    def run(self):
+        buffer = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                line = self._queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                line = None
+
+            if line is _STOP:
+                self._write(buffer)
+                self._close()
+                return
+            if line is not None:
+                buffer.append(line)
+
+            if len(buffer) >= self.batch_size or time.time() >= deadline:
+                self._write(buffer)
+                buffer = []
+                deadline = time.time() + self.flush_interval
+
+    def _write(self, lines):
+        """
+        Appends lines to the current capture file.
+        """
+        if not lines:
+            return
+        try:
+            td = self._open()
+            td.write("\n".join(lines))
+            td.write("\n")
+            td.flush()
+            self.written += len(lines)
+        except OSError as e:
+            print("[ERROR] TweetWriter: {}".format(e))
+
+    def _open(self):
+        """
+        Returns the file for the current hour, rotating the previous file if
+        the hour has changed.
+        """
+        path = self.path
+        if self.rotate:
+            root, ext = os.path.splitext(self.path)
+            path = "{}_{}{}".format(root, datetime.now().strftime("%Y%m%d%H"),
+                                    ext)
+        if path != self._file_path:
+            self._close()
+            self._file = open(path, "a")
+            self._file_path = path
+        return self._file
+
+    def _close(self):
+        """
+        Closes the current file and gzips it if rotation is compressed.
+        """
+        if self._file is None:
+            return
+        self._file.close()
+        if self.rotate and self.compress:
+            with open(self._file_path, "rb") as src, \
+                    gzip.open(self._file_path + ".gz", "ab") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self._file_path)
+        self._file = None
+        self._file_path = None
@@ -0,0 +1,185 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from scipy import sparse
+
+from calculate_similarity import Similarity
+from manipulate_tweets import ManipulateTweet
+from synset_cache import SynsetCache
+
+"""
+Fitted TF-IDF vocabulary.
+A vocabulary and its IDF are fitted once over a reference corpus, saved as
+.npy files and loaded memory-mapped. Later batches are transformed onto the
+same feature index, so a feature similarity matrix saved along with the
+vocabulary stays valid for them.
+"""
+
+VOCABULARY_VERSION = 1
+DEFAULT_PATH = "data/vocabulary"
+
+_ARRAYS = ("features", "idf")
+_SIM_ARRAYS = ("sim_indptr", "sim_indices", "sim_data")
+
+
+def smooth_idf(n_documents, df):
+    """
+    IDF with the smoothing of `TfidfVectorizer`.
+    """
+    return np.log((1.0 + n_documents) / (1.0 + np.asarray(df))) + 1
+
+
+def tfidf(counts, idf):
+    """
+    Weights a sparse term count matrix by `idf` and l2-normalizes its rows,
+    like `TfidfVectorizer`. Returns a CSR matrix.
+    """
+    X = sparse.csr_matrix(counts.multiply(idf))
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(X).tocsr()
+
+
+class TfidfVocabulary:
+    """
+    Sorted feature list and IDF of a reference corpus.
+    """
+    def __init__(self, features, idf, feature_sim=None):
+        """
+        TfidfVocabulary class constructor.
+        `features` - sorted array of UTF-8 encoded terms.
+        `idf` - IDF of each feature.
+        `feature_sim` - optional feature similarity matrix of `features`.
+        """
+        self._features = features
+        self._feature_list = None
+        self.idf = idf
+        self.feature_sim = feature_sim
+
+    @classmethod
+    def fit(cls, tokens):
+        """
+        Fits the vocabulary and IDF of a `TokenCorpus`.
+        """
+        order = sorted(range(len(tokens.vocabulary)),
+                       key=tokens.vocabulary.__getitem__)
+        counts = tokens.counts()[:, order]
+        df = np.bincount(counts.indices, minlength=counts.shape[1])
+        features = np.array([tokens.vocabulary[i].encode("utf-8")
+                             for i in order] or [b""])[:len(order)]
+        return cls(features, smooth_idf(counts.shape[0], df))
+
+    @property
+    def features(self):
+        """
+        Feature terms, in feature index order. Decoded once and shared by
+        every `Similarity` using the vocabulary, which must not modify it.
+        """
+        if self._feature_list is None:
+            self._feature_list = [term.decode("utf-8")
+                                  for term in self._features]
+        return self._feature_list
+
+    def __len__(self):
+        return len(self._features)
+
+    def feature_ids(self, terms):
+        """
+        Returns the feature index of each term, or -1 for unknown terms.
+        """
+        keys = np.array([term.encode("utf-8") for term in terms] or [b""])
+        keys = keys[:len(terms)]
+        if len(self._features) == 0:
+            return np.full(len(terms), -1, dtype=np.int64)
+        ids = np.searchsorted(self._features, keys)
+        ids[ids == len(self._features)] = 0
+        return np.where(self._features[ids] == keys, ids, -1)
+
+    def transform(self, tokens):
+        """
+        Returns the TF-IDF matrix of a `TokenCorpus` over the fitted
+        features. Unknown terms are ignored.
+        """
+        counts = tokens.counts().tocoo()
+        columns = self.feature_ids(tokens.vocabulary)[counts.col]
+        known = columns >= 0
+        counts = sparse.csr_matrix(
+            (counts.data[known], (counts.row[known], columns[known])),
+            shape=(counts.shape[0], len(self)))
+        empty = np.sum(np.diff(counts.indptr) == 0)
+        if empty > 0:
+            print("[WARNING] {} documents have no known features".format(
+                empty))
+        return tfidf(counts, self.idf)
+
+    def save(self, path, feature_sim=None):
+        """
+        Saves the vocabulary to the `path` directory, with `feature_sim` (or
+        the one it was loaded with) if given.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        arrays = {"features": self._features, "idf": self.idf}
+        feature_sim = feature_sim if feature_sim is not None \
+            else self.feature_sim
+        if feature_sim is not None:
+            feature_sim = sparse.csr_matrix(feature_sim)
+            arrays.update(sim_indptr=feature_sim.indptr,
+                          sim_indices=feature_sim.indices,
+                          sim_data=feature_sim.data)
+        for name, values in arrays.items():
+            np.save(os.path.join(path, name + ".npy"), values)
+        with open(os.path.join(path, "meta.json"), "w") as meta:
+            json.dump({"version": VOCABULARY_VERSION,
+                       "feature_sim": feature_sim is not None}, meta)
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Loads a vocabulary saved by `save`. Arrays are memory-mapped unless
+        `mmap_mode` is None.
+        """
+        with open(os.path.join(path, "meta.json")) as meta:
+            meta = json.load(meta)
+        if meta.get("version") != VOCABULARY_VERSION:
+            raise ValueError("Vocabulary at {} has an unsupported "
+                             "version".format(path))
+        names = _ARRAYS + (_SIM_ARRAYS if meta["feature_sim"] else ())
+        arrays = {name: np.load(os.path.join(path, name + ".npy"),
+                                mmap_mode=mmap_mode)
+                  for name in names}
+
+        feature_sim = None
+        if meta["feature_sim"]:
+            size = len(arrays["features"])
+            feature_sim = sparse.csr_matrix(
+                (arrays["sim_data"], arrays["sim_indices"],
+                 arrays["sim_indptr"]), shape=(size, size))
+        return cls(arrays["features"], arrays["idf"], feature_sim)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Fits a TF-IDF vocabulary and its feature similarity "
+                    "matrix over the tweets of a capture file.")
+    parser.add_argument("path", help="reference capture file")
+    parser.add_argument("--output", default=DEFAULT_PATH)
+    parser.add_argument("--cache", default=None,
+                        help="SynsetCache file to use; no cache by default")
+    args = parser.parse_args()
+
+    manip_tweet = ManipulateTweet()
+    tokens = manip_tweet.tokenize_tweets(manip_tweet.preprocess_tweet(
+        manip_tweet.iter_tweets_data(args.path)), batch_size=1000)
+    vocabulary = TfidfVocabulary.fit(tokens)
+    cache = SynsetCache(args.cache) if args.cache else None
+    feature_sim = Similarity(vocabulary=vocabulary,
+                             cache=cache).feature_similarity()
+    if cache is not None:
+        cache.close()
+    print("Vocabulary of {} features written to {}".format(
+        len(vocabulary), vocabulary.save(args.output, feature_sim)))
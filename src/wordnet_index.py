@@ -0,0 +1,229 @@
+import os
+import json
+
+import nltk
+import numpy as np
+
+from nltk.corpus import wordnet as wn
+
+"""
+Offline WordNet index for fast term lookups.
+`build_index` precomputes, for every synset, its hypernym ancestors with
+their shortest distances, its depths and its derivationally related form,
+and for every WordNet lemma its candidate synsets. Arrays are saved as .npy
+files and memory-mapped by `WordNetIndex`, which reproduces
+`Similarity._get_synsets` and `wup_similarity` with array lookups instead
+of graph walks.
+"""
+
+INDEX_VERSION = 1
+DEFAULT_PATH = "data/wordnet_index"
+ROOT = -1
+ROOT_NAME = "*ROOT*"
+
+_ARRAYS = ("names", "pos", "min_depth", "max_depth", "related",
+           "ancestor_indptr", "ancestors", "ancestor_distances",
+           "lemmas", "lemma_indptr", "lemma_synsets")
+
+
+def build_index(path=DEFAULT_PATH):
+    """
+    Builds the index over the whole WordNet lemma vocabulary and saves it
+    to the `path` directory.
+    """
+    synsets = list(wn.all_synsets())
+    ids = {synset.name(): i for i, synset in enumerate(synsets)}
+
+    related = np.full(len(synsets), ROOT, dtype=np.int32)
+    ancestor_indptr = [0]
+    ancestors, ancestor_distances = [], []
+    for i, synset in enumerate(synsets):
+        for ancestor, distance in synset._shortest_hypernym_paths(False).items():
+            ancestors.append(ids[ancestor.name()])
+            ancestor_distances.append(distance)
+        ancestor_indptr.append(len(ancestors))
+
+        lemmas = synset.lemmas()
+        if len(lemmas) > 0:
+            derived = lemmas[0].derivationally_related_forms()
+            if len(derived) > 0:
+                related[i] = ids[derived[0].synset().name()]
+
+    lemmas = sorted(wn.all_lemma_names())
+    lemma_indptr = [0]
+    lemma_synsets = []
+    for lemma in lemmas:
+        lemma_synsets.extend(ids[synset.name()] for synset in wn.synsets(lemma))
+        lemma_indptr.append(len(lemma_synsets))
+
+    arrays = {
+        "names": _encode([synset.name() for synset in synsets]),
+        "pos": _encode([synset.pos() for synset in synsets]),
+        "min_depth": np.array([s.min_depth() for s in synsets], np.int32),
+        "max_depth": np.array([s.max_depth() for s in synsets], np.int32),
+        "related": related,
+        "ancestor_indptr": np.array(ancestor_indptr, np.int64),
+        "ancestors": np.array(ancestors, np.int32),
+        "ancestor_distances": np.array(ancestor_distances, np.int32),
+        "lemmas": _encode(lemmas),
+        "lemma_indptr": np.array(lemma_indptr, np.int64),
+        "lemma_synsets": np.array(lemma_synsets, np.int32),
+    }
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + ".npy"), array)
+    with open(os.path.join(path, "meta.json"), "w") as meta:
+        json.dump(_index_key(), meta)
+    return path
+
+
+class WordNetIndex:
+    """
+    Memory-mapped WordNet index. Synsets are referred to by integer ids.
+    """
+    def __init__(self, path=DEFAULT_PATH):
+        """
+        WordNetIndex class constructor.
+        `path` - directory written by `build_index`. Raises ValueError if the
+        index was built with another index, NLTK or WordNet version.
+        """
+        with open(os.path.join(path, "meta.json")) as meta:
+            if json.load(meta) != _index_key():
+                raise ValueError("WordNet index at {} is outdated, rebuild it "
+                                 "with build_index".format(path))
+        for name in _ARRAYS:
+            setattr(self, "_" + name,
+                    np.load(os.path.join(path, name + ".npy"), mmap_mode="r"))
+        self._ancestor_dicts = {}
+        self._name_ids = None
+
+    def synset_ids(self, term):
+        """
+        Ids of the synsets `wn.synsets(term)` returns, in the same order.
+        Terms that are not WordNet lemmas (e.g. inflected forms) fall back to
+        `wn.synsets`.
+        """
+        key = term.encode("utf-8")
+        i = np.searchsorted(self._lemmas, key)
+        if i < len(self._lemmas) and self._lemmas[i] == key:
+            start, end = self._lemma_indptr[i], self._lemma_indptr[i + 1]
+            return self._lemma_synsets[start:end].tolist()
+
+        if self._name_ids is None:
+            self._name_ids = {name.decode("utf-8"): i
+                              for i, name in enumerate(self._names)}
+        return [self._name_ids[synset.name()] for synset in wn.synsets(term)]
+
+    def name(self, synset_id):
+        return ROOT_NAME if synset_id == ROOT else \
+            self._names[synset_id].decode("utf-8")
+
+    def synset(self, synset_id):
+        """
+        Returns the NLTK Synset of an id.
+        """
+        return wn.synset(self.name(synset_id))
+
+    def best_synsets(self, term1, term2):
+        """
+        Array-backed `Similarity._get_synsets`. Gets best synsets of each term
+        based on the highest path similarity among all pairs compared; if a
+        synset is not a noun or verb, it gets its related form instead.
+        """
+        synset_ids1 = self.synset_ids(term1)
+        synset_ids2 = self.synset_ids(term2)
+        if len(synset_ids1) == 0 or len(synset_ids2) == 0:
+            return None, None
+
+        max_score = -1.0
+        best_pair = [None, None]
+        for i in synset_ids1:
+            for j in synset_ids2:
+                score = 1.0 / (self.shortest_path_distance(i, j, True) + 1)
+                if score > max_score:
+                    max_score = score
+                    best_pair = [i, j]
+
+        for k in range(2):
+            if best_pair[k] is not None and \
+                    self._pos[best_pair[k]] not in (b'n', b'v'):
+                related = int(self._related[best_pair[k]])
+                best_pair[k] = None if related == ROOT else related
+        return tuple(best_pair)
+
+    def shortest_path_distance(self, synset_id1, synset_id2,
+                               simulate_root=False):
+        """
+        Array-backed `Synset.shortest_path_distance`.
+        """
+        if synset_id1 == synset_id2:
+            return 0
+        if synset_id2 == ROOT:
+            synset_id1, synset_id2 = synset_id2, synset_id1
+        if synset_id1 == ROOT:
+            if not simulate_root:
+                return None
+            return max(self._ancestor_dict(synset_id2).values()) + 1
+
+        dist1 = self._ancestor_dict(synset_id1)
+        dist2 = self._ancestor_dict(synset_id2)
+        distances = [d + dist2[a] for a, d in dist1.items() if a in dist2]
+        if simulate_root:
+            distances.append(max(dist1.values()) + max(dist2.values()) + 2)
+        return min(distances) if distances else None
+
+    def wup_similarity(self, synset_id1, synset_id2, simulate_root=True):
+        """
+        Array-backed `wn.wup_similarity`, using the minimum depth to pick the
+        lowest common subsumer like NLTK does.
+        """
+        need_root = simulate_root and (self._pos[synset_id1] != b'n' or
+                                       self._pos[synset_id2] != b'n')
+        common = set(self._ancestor_dict(synset_id1)).intersection(
+            self._ancestor_dict(synset_id2))
+        candidates = [(int(self._min_depth[a]), a) for a in common]
+        if need_root:
+            candidates.append((0, ROOT))
+        if not candidates:
+            return None
+
+        deepest = max(depth for depth, a in candidates)
+        subsumers = sorted((a for depth, a in candidates if depth == deepest),
+                           key=self.name)
+        subsumer = synset_id1 if synset_id1 in subsumers else subsumers[0]
+
+        depth = (0 if subsumer == ROOT else int(self._max_depth[subsumer])) + 1
+        len1 = self.shortest_path_distance(synset_id1, subsumer, need_root)
+        len2 = self.shortest_path_distance(synset_id2, subsumer, need_root)
+        if len1 is None or len2 is None:
+            return None
+        return (2.0 * depth) / (len1 + len2 + 2 * depth)
+
+    def _ancestor_dict(self, synset_id):
+        """
+        Ancestors of a synset, including itself, with their shortest
+        distances.
+        """
+        ancestors = self._ancestor_dicts.get(synset_id)
+        if ancestors is None:
+            start = self._ancestor_indptr[synset_id]
+            end = self._ancestor_indptr[synset_id + 1]
+            ancestors = dict(zip(self._ancestors[start:end].tolist(),
+                                 self._ancestor_distances[start:end].tolist()))
+            self._ancestor_dicts[synset_id] = ancestors
+        return ancestors
+
+
+def _index_key():
+    return {"index": INDEX_VERSION, "nltk": nltk.__version__,
+            "wordnet": wn.get_version()}
+
+
+def _encode(strings):
+    return np.array([s.encode("utf-8") for s in strings])
+
+
+if __name__ == '__main__':
+    print("WordNet index written to {}".format(build_index()))